@@ -28,7 +28,7 @@ setup(name='pws_calibration_suite',
       author='Nick Anthony',
       author_email='nicholas.anthony@northwestern.edu',
       url='https://github.com/nanthony21/pws_calibration_suite',
-      python_requires='>=3.7',
+      python_requires='>=3.8',
       install_requires=['numpy',
                         'matplotlib',
                         'pandas',
@@ -0,0 +1,64 @@
+from __future__ import annotations
+import logging
+import threading
+import typing as t_
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from pws_calibration_suite.comparison.analyzer import AsyncAnalyzer
+
+if t_.TYPE_CHECKING:
+    from pws_calibration_suite.comparison import AbstractMeasurementLoader
+
+
+class AnalysisWorker(QObject):
+    """
+    Acquires and analyzes calibration data on a background thread and reports back through Qt signals so that a
+    `RoutinePlugin` doesn't freeze the GUI. The signals are emitted from background threads, Qt queues them so that
+    slots of objects belonging to the GUI thread are run on the GUI thread.
+
+    Args:
+        loaderFactory: A function that acquires and/or loads the data and returns the loader for the analysis. It is
+            run on the background thread.
+        parent: The parent `QObject`.
+        analyzerKwargs: Keyword arguments for `AsyncAnalyzer`.
+    """
+    statusChanged = pyqtSignal(str)  # A short description of what is currently being done.
+    progress = pyqtSignal(str, int, int)  # The name of the stage, the number of measurements that have finished it, and the number of measurements in it.
+    measurementScored = pyqtSignal(str, object)  # The name of the measurement and its row of the `Analyzer` output as a `pd.Series`.
+    finished = pyqtSignal(object)  # The full `Analyzer` output as a `pd.DataFrame`.
+    failed = pyqtSignal(object)  # The exception that stopped the routine.
+
+    def __init__(self, loaderFactory: t_.Callable[[], AbstractMeasurementLoader], parent: QObject = None, **analyzerKwargs):
+        super().__init__(parent=parent)
+        self._loaderFactory = loaderFactory
+        self._analyzerKwargs = analyzerKwargs
+        self._thread: t_.Optional[threading.Thread] = None
+        self.analyzer: t_.Optional[AsyncAnalyzer] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="AnalysisWorker", daemon=True)
+        self._thread.start()
+
+    def isRunning(self) -> bool:
+        return self._thread is not None and (self._thread.is_alive() or (self.analyzer is not None and not self.analyzer.future.done()))
+
+    def _run(self):
+        try:
+            self.statusChanged.emit("Acquiring")
+            loader = self._loaderFactory()
+            self.statusChanged.emit("Analyzing")
+            self.analyzer = AsyncAnalyzer(loader, onProgress=lambda stage, n, total: self.progress.emit(stage.value, n, total), **self._analyzerKwargs)
+        except Exception as e:
+            logging.getLogger(__name__).exception(e)
+            self.failed.emit(e)
+            return
+        for name, future in self.analyzer.measurementFutures.items():
+            future.add_done_callback(lambda f, name=name: self.measurementScored.emit(name, f.result()) if f.exception() is None else None)
+        self.analyzer.future.add_done_callback(self._onFinished)
+
+    def _onFinished(self, future):
+        if future.exception() is not None:
+            logging.getLogger(__name__).error("Analysis failed.", exc_info=future.exception())
+            self.failed.emit(future.exception())
+        else:
+            self.finished.emit(future.result())
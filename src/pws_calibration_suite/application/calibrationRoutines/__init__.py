@@ -23,7 +23,8 @@ class RoutinePlugin(abc.ABC):
 
     @abc.abstractmethod
     def run(self):
-        """Begin the measurement routine"""
+        """Begin the measurement routine. This is called from the GUI thread so it should return quickly, long
+        acquisitions and analysis should be run on a background thread. See `AnalysisWorker`."""
         pass
 
 
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import joblib
+from PyQt5.QtWidgets import QMessageBox, QProgressDialog
 from mpl_qt_viz.visualizers import DockablePlotWindow
 from sklearn.preprocessing import StandardScaler
 
@@ -9,7 +10,7 @@ from pws_calibration_suite.application.calibrationRoutines import RoutinePlugin
 import typing as t_
 import pathlib as pl
 
-from pws_calibration_suite.comparison.analyzer import Analyzer
+from pws_calibration_suite.application.analysisWorker import AnalysisWorker
 from pws_calibration_suite.application.calibrationRoutines.dish1._loader import DefaultLoader
 import shutil
 import time
@@ -26,6 +27,9 @@ class MyRoutine(RoutinePlugin):
     def __init__(self, controller: Controller, visualizer: DockablePlotWindow):
         self._controller = controller
         self._visualizer = visualizer
+        self._worker: t_.Optional[AnalysisWorker] = None
+        self._progressDialog: t_.Optional[QProgressDialog] = None
+        self._scaler: t_.Optional[StandardScaler] = None
 
     @classmethod
     def instantiate(cls, controller: Controller, visualizer: DockablePlotWindow):
@@ -35,21 +39,46 @@ class MyRoutine(RoutinePlugin):
         return "Plate1: ITO"
 
     def run(self):
+        if self._worker is not None and self._worker.isRunning():
+            logging.getLogger(__name__).warning(f"{self.getName()} is already running.")
+            return self._worker
         path = pl.Path.home() / 'testingAcquisition'
         if not path.exists():
             path.mkdir()
-        loader = self._acquire(path, simulated=True)
-        an = Analyzer(loader, blurSigma=3)
+        self._scaler = joblib.load(scalerPath)
+        self._progressDialog = QProgressDialog("Acquiring", None, 0, 0, self._visualizer)
+        self._progressDialog.setWindowTitle(self.getName())
+        self._progressDialog.setMinimumDuration(0)
+        self._progressDialog.show()
+        # The acquisition and analysis are run on a background thread so that the GUI stays responsive.
+        self._worker = AnalysisWorker(lambda: self._acquire(path, simulated=True), self._visualizer, blurSigma=3)
+        self._worker.statusChanged.connect(self._progressDialog.setLabelText)
+        self._worker.progress.connect(self._showProgress)
+        self._worker.measurementScored.connect(self._showResult)
+        self._worker.finished.connect(self._progressDialog.close)
+        self._worker.failed.connect(self._showError)
+        self._worker.start()
+        return self._worker
+
+    def _showProgress(self, stage: str, finished: int, total: int):
+        self._progressDialog.setLabelText(f"{stage} measurements")
+        self._progressDialog.setMaximum(total)
+        self._progressDialog.setValue(finished)
+
+    def _showResult(self, name: str, row: pd.Series):
+        """Plot the results of each measurement as soon as it has been scored."""
         # Convert the score object to an dataframe of values
-        df = generateFeatures(an.output)
-        scaler: StandardScaler = joblib.load(scalerPath)
-        df[:] = scaler.transform(df) / 100 + 1
+        df = generateFeatures(pd.DataFrame([row]))
+        # Only plot the features that the saved scaler was fit on. Newer features are appended to the end of `generateFeatures`.
+        df = df[getattr(self._scaler, 'feature_names_in_', df.columns[:self._scaler.n_features_in_])]
+        df[:] = self._scaler.transform(df) / 100 + 1
 
-        row = df.iloc[0]  # We are assuming there is only one measurement (row) in the dataframe.
-        _ = RadarPlot(self._visualizer, row)
-        self._visualizer.addWidget(_, "Calibration Results")
+        _ = RadarPlot(self._visualizer, df.iloc[0])
+        self._visualizer.addWidget(_, f"Calibration Results: {name}")
 
-        return an.output
+    def _showError(self, e: Exception):
+        self._progressDialog.close()
+        QMessageBox.warning(self._visualizer, "Calibration Failed", f"{self.getName()} failed with error: {str(e)}")
 
     def _acquire(self, path: pl.Path, simulated: bool = False) -> DefaultLoader:
         """
@@ -85,13 +114,14 @@ def generateFeatures(rawDf: pd.DataFrame):
     funcDict = {
         'latXCorr': lambda row: row.score.latxcorr.score,
         'latXCorr_cdr': lambda row: np.sqrt((row.score.latxcorr.cdrY**2 + row.score.latxcorr.cdrX**2)/2),  # RMS of cdrx and cdry. Looking at data by eye this didn't look that useful, I'm inclined to get rid of it.
-        'latXCorr_cdr_eccent': lambda row: row.score.latxcorr.cdrY/row.score.latxcorr.cdrX,  # TODO this is not how eccentricity is measured and we will need to measure the major and minor axes of the the CDR not just X and Y
+        'latXCorr_cdr_eccent': lambda row: row.score.latxcorr.cdrY/row.score.latxcorr.cdrX,  # TODO this is not how eccentricity is measured. Kept as is since the saved scaler was fit on it, see `latXCorr_cdr_ellipseEccent`.
         'axXCorr': lambda row: row.score.axxcorr.score,
         'axXCorr_cdr': lambda row: row.score.axxcorr.cdr,
         'axXCorr_shift': lambda row: row.score.axxcorr.shift,
         'nrmse': lambda row: row.score.nrmse.score,
         'ssim': lambda row:  row.score.ssim.score,
-        'reflectance': lambda row: row.score.reflectance.reflectanceRatio
+        'reflectance': lambda row: row.score.reflectance.reflectanceRatio,
+        'latXCorr_cdr_ellipseEccent': lambda row: np.nan if row.score.latxcorr.cdrMajor is None else row.score.latxcorr.cdrEccentricity,  # Eccentricity of the ellipse fitted to the correlation peak. Not available for scores saved before the fit was added.
     }
     df = pd.DataFrame()
     for k, v in funcDict.items():
@@ -2,10 +2,12 @@ from __future__ import annotations
 import logging
 import os
 import typing
+import numpy as np
 from pwspy import dataTypes as pwsdt
 from pwspy.analysis import pws as pwsAnalysis, AbstractHDFAnalysisResults
 from glob import glob
 
+from pws_calibration_suite.comparison import instrumentation
 from pws_calibration_suite.comparison.fileTypes import TransformedData
 from pwspy.dataTypes import AnalysisManager
 from pwspy.utility.misc import cached_property
@@ -28,6 +30,7 @@ class ITOMeasurement(AnalysisManager):
     """
 
     ANALYSIS_NAME = 'ITOCalibration'
+    TEMPLATE_CACHE_DIR = 'templateCache'  # The blurred reflectance cubes used when this measurement is a template are cached in this subfolder.
 
     def __init__(self, homeDir: str, itoAcq: pwsdt.AcqDir, refAcq: pwsdt.AcqDir,
                  settings: pwsAnalysis.PWSAnalysisSettings, name: str, readOnly: bool = False):
@@ -80,16 +83,56 @@ class ITOMeasurement(AnalysisManager):
     def idTag(self) -> str:
         return self._itoAcq.pws.idTag.replace(':', '_') + '__' + self._refAcq.idTag.replace(':', '_') # We want this to be able to be used as a file name so sanitize the characters
 
-    def saveTransformedData(self, result: TransformedData, overwrite: bool = False):
+    def saveTransformedData(self, result: TransformedData, overwrite: bool = False, dataStream: typing.Optional[TransformedData.DataStream] = None):
         if (result.templateIdTag in self.listTransformedData()) and (not overwrite):
             raise FileExistsError(f"A calibration result named {result.templateIdTag} already exists.")
-        result.toHDF(self.filePath, result.templateIdTag, overwrite=overwrite)
+        with instrumentation.measurement(self.name), instrumentation.span('write'):  # When streaming, this includes warping the data.
+            result.toHDF(self.filePath, result.templateIdTag, overwrite=overwrite, dataStream=dataStream)
+        instrumentation.count('bytesWritten', os.path.getsize(os.path.join(self.filePath, TransformedData.name2FileName(result.templateIdTag))), self.name)
 
     def loadTransformedData(self, templateIdTag: str) -> TransformedData:
         try:
-            return TransformedData.load(self.filePath, templateIdTag)
+            with instrumentation.span('load', self.name):  # Only opens the file, the bytes are counted when the data is read, see `TransformedData.loadValidData`.
+                return TransformedData.load(self.filePath, templateIdTag)
         except OSError:
             raise OSError(f"No TransformedData file found for template: {templateIdTag} for measurement: {self.name}")
 
     def listTransformedData(self) -> typing.Tuple[str]:
         return tuple([TransformedData.fileName2Name(f) for f in glob(os.path.join(self.filePath, f'*{TransformedData.FileSuffix}'))])
+
+    def _templateCachePath(self, blurSigma: typing.Optional[float], dtype: np.dtype) -> str:
+        sigmaName = 'none' if blurSigma is None else f"{float(blurSigma):g}"
+        return os.path.join(self.filePath, self.TEMPLATE_CACHE_DIR, f"{self.idTag}_blur{sigmaName}_{np.dtype(dtype).name}.npy")
+
+    def loadTemplateCache(self, blurSigma: typing.Optional[float], dtype: np.dtype) -> typing.Optional[np.memmap]:
+        """
+        Load the cached reflectance of this measurement, blurred by `blurSigma`, for use as a template.
+
+        Returns:
+            A read-only memory-map of an uncompressed `.npy` file. Other processes can map the same file from its
+            `filename`. `None` if nothing is cached or if the analysis has been regenerated since the cache was saved.
+        """
+        path = self._templateCachePath(blurSigma, dtype)
+        analysisPath = os.path.join(self.filePath, self.getAnalysisResultsClass().name2FileName(self.ANALYSIS_NAME))
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(analysisPath):
+            instrumentation.count('templateCache.miss', measurementName=self.name)
+            return None
+        instrumentation.count('templateCache.hit', measurementName=self.name)
+        return np.load(path, mmap_mode='r')
+
+    def saveTemplateCache(self, array: np.ndarray, blurSigma: typing.Optional[float], dtype: np.dtype) -> np.memmap:
+        """Save the blurred template reflectance for `loadTemplateCache`. The file is written under a temporary name and
+        then renamed so that other processes never see a partially written file. Returns a memory-map of the saved file."""
+        path = self._templateCachePath(blurSigma, dtype)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tempPath = f"{path}.{os.getpid()}.tmp"
+        with instrumentation.span('write', self.name):
+            with open(tempPath, 'wb') as f:
+                np.save(f, np.asarray(array, dtype=dtype))
+            os.replace(tempPath, path)
+        instrumentation.count('bytesWritten', os.path.getsize(path), self.name)
+        return np.load(path, mmap_mode='r')
+
+    def clearTemplateCache(self):
+        for f in glob(os.path.join(self.filePath, self.TEMPLATE_CACHE_DIR, f"{self.idTag}_*.npy")):
+            os.remove(f)
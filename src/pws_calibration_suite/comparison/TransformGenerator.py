@@ -1,12 +1,12 @@
 from __future__ import annotations
 import enum
-import time
 import typing
 
 import numpy as np
 import logging
 
 from pwspy.analysis import pws as pwsAnalysis
+from pws_calibration_suite.comparison import instrumentation
 from pwspy.utility.machineVision import ORBRegisterTransform, SIFTRegisterTransform, crossCorrelateRegisterTranslation
 
 
@@ -43,10 +43,9 @@ class TransformGenerator:
             ims: An iterable of PWS analysis results. This funciton will return the affine transformation between the template and each of these analysis results.
         """
         logger = logging.getLogger(__name__)
-        matchTime = time.time()
         logger.debug("Start match.")
-        trans, self._debugAnimationRef = self._matcherFunc(self._template.meanReflectance, [im.meanReflectance for im in ims], debugPlots=self._debugMode)
-        logger.debug(f"Image matching took {time.time() - matchTime} seconds")
+        with instrumentation.span('match'):
+            trans, self._debugAnimationRef = self._matcherFunc(self._template.meanReflectance, [im.meanReflectance for im in ims], debugPlots=self._debugMode)
         return trans
 
     class Method(enum.Enum):
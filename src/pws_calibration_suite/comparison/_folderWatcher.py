@@ -0,0 +1,139 @@
+from __future__ import annotations
+import logging
+import os
+import threading
+import time
+import typing
+
+
+def _lastModified(directory: str) -> float:
+    """The most recent modification time of `directory` or anything inside of it."""
+    latest = os.path.getmtime(directory)
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+            except OSError:  # The file was removed while we were looking.
+                pass
+    return latest
+
+
+class FolderWatcher:
+    """
+    Finds new subfolders of a directory once they have stopped changing. If the optional `watchdog` package is
+    installed then file system events (inotify on Linux) wake the watcher up as soon as a subfolder is created or moved
+    into the directory, otherwise the directory is polled. Changes inside of the subfolders don't wake the watcher, new
+    folders are checked again every `settleTime` seconds until they have settled.
+
+    Args:
+        directory: The directory to watch. Each subfolder is reported once.
+        settleTime: A new folder is only reported once nothing inside of it has been modified for this many seconds.
+            This skips acquisitions that are still being written until they are finished.
+        ignoreExisting: If `True` then the folders that already exist are never reported.
+    """
+    pollInterval = 30.0  # The number of seconds between scans of the directory. Also used as a fallback when `watchdog` is installed in case events are missed.
+
+    def __init__(self, directory: str, settleTime: float = 60.0, ignoreExisting: bool = False):
+        self._directory = os.path.abspath(directory)
+        self._settleTime = settleTime
+        self._reported: typing.Dict[str, float] = {}  # The folders that have been reported, along with their modification time when they were reported.
+        self._retry: typing.Set[str] = set()  # Reported folders that should be reported again if they are modified.
+        self._pending: typing.Dict[str, float] = {}  # New folders that are waiting to settle, along with their last modification time.
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._observer = None
+        if ignoreExisting:
+            self._reported.update({path: float('inf') for path in self._listFolders()})
+
+    def _listFolders(self) -> typing.List[str]:
+        return sorted(f.path for f in os.scandir(self._directory) if f.is_dir())
+
+    def start(self):
+        """Start listening for file system events. Does nothing if `watchdog` isn't installed."""
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            logging.getLogger(__name__).info(f"`watchdog` is not installed. Polling {self._directory} every {self.pollInterval} seconds.")
+            return
+
+        class Handler(FileSystemEventHandler):
+            def on_created(handler, event):
+                if event.is_directory:
+                    self._wake.set()
+
+            def on_moved(handler, event):
+                if event.is_directory and os.path.dirname(os.path.abspath(event.dest_path)) == self._directory:
+                    self._wake.set()
+
+        self._observer = Observer()
+        self._observer.schedule(Handler(), self._directory, recursive=False)  # Only events for the direct children of the directory.
+        self._observer.start()
+
+    def stop(self):
+        """Stop listening for events and wake up any call to `waitForNew`."""
+        self._stopped.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped.is_set()
+
+    def retryWhenModified(self, path: str):
+        """Report a folder that was already reported again once it has been modified. For example if it failed to load
+        because some of its files were missing."""
+        try:
+            self._reported[path] = _lastModified(path)  # Anything written while the folder was being loaded doesn't count.
+        except OSError:
+            pass
+        self._retry.add(path)
+
+    def poll(self) -> typing.List[str]:
+        """Scan the directory once and return the new folders that have settled."""
+        now = time.time()
+        ready = []
+        for path in self._listFolders():
+            if path in self._reported and path not in self._retry:
+                continue
+            try:
+                modified = _lastModified(path)
+            except OSError:  # The folder was removed.
+                continue
+            if path in self._retry and modified <= self._reported[path]:
+                continue
+            if self._pending.get(path) != modified:  # Either new or it changed since we last looked. Restart the clock.
+                self._pending[path] = modified
+            if now - modified >= self._settleTime:
+                del self._pending[path]
+                self._retry.discard(path)
+                self._reported[path] = modified
+                ready.append(path)
+        return ready
+
+    def waitForNew(self, timeout: float = None) -> typing.List[str]:
+        """
+        Block until there are new folders that have settled.
+
+        Args:
+            timeout: The maximum number of seconds to wait. If `None` then wait until `stop` is called.
+
+        Returns:
+            The paths of the new folders. Empty if the timeout passed or the watcher was stopped.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.stopped:
+            self._wake.clear()
+            ready = self.poll()
+            if len(ready) > 0:
+                return ready
+            wait = self.pollInterval if len(self._pending) == 0 else min(self.pollInterval, self._settleTime)  # Check back once pending folders could have settled.
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+            self._wake.wait(wait)
+        return []
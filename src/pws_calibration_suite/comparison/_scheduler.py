@@ -0,0 +1,87 @@
+from __future__ import annotations
+import concurrent.futures as cf
+import logging
+import os
+import typing
+
+
+def availableMemory() -> typing.Optional[int]:
+    """The number of bytes of RAM that can currently be allocated without swapping. Uses `psutil` if it is installed,
+    otherwise `/proc/meminfo` is read. Returns `None` if the available memory can't be determined."""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024  # The value is in kB
+    except OSError:
+        pass
+    return None
+
+
+class MemoryAwareScheduler:
+    """
+    Runs jobs on a pool of worker processes while keeping the estimated memory in use within the memory that is
+    available. The number of workers is chosen from the number of CPUs and the available memory when the pool is
+    started, and no new job is started while the available memory is too low for another one. Results are returned to
+    the parent process so that a single process is responsible for writing them to file.
+
+    Args:
+        jobMemory: The estimated peak memory (in bytes) of a worker process while it is running a job.
+        maxProcesses: The maximum number of worker processes. If `None` then the number of CPUs is used.
+        initializer: An optional function that is run once in each worker process when it starts.
+        initArgs: The arguments for `initializer`.
+    """
+    memoryFraction = 0.8  # Only this fraction of the available memory is used for jobs, leaving the rest as headroom for the estimates being wrong.
+    pollInterval = 1.0  # When memory is low, the number of seconds to wait before checking the available memory again.
+
+    def __init__(self, jobMemory: int, maxProcesses: int = None, initializer: typing.Callable = None, initArgs: typing.Tuple = ()):
+        self._jobMemory = max(1, int(jobMemory))
+        self._maxProcesses = os.cpu_count() if maxProcesses is None else maxProcesses
+        self._initializer = initializer
+        self._initArgs = initArgs
+
+    def numWorkers(self) -> int:
+        """The number of worker processes that fit within the available memory, at least 1."""
+        memory = availableMemory()
+        if memory is None:
+            return max(1, self._maxProcesses)
+        return max(1, min(self._maxProcesses, int(memory * self.memoryFraction) // self._jobMemory))
+
+    def _hasRoomForJob(self) -> bool:
+        memory = availableMemory()
+        return memory is None or memory * self.memoryFraction >= self._jobMemory
+
+    def map(self, func: typing.Callable, items: typing.Sequence) -> typing.Iterator[typing.Tuple[int, typing.Any]]:
+        """
+        Call `func(item)` for each item in a worker process.
+
+        Args:
+            func: A picklable function.
+            items: The inputs to `func`, each one must be picklable.
+
+        Yields:
+            The index of the item and the result of `func` for that item, in the order that the jobs finish.
+        """
+        logger = logging.getLogger(__name__)
+        numWorkers = min(self.numWorkers(), len(items))
+        if numWorkers == 0:
+            return
+        logger.debug(f"Starting {numWorkers} worker processes with an estimated {self._jobMemory / 2**30:.2f} GiB per job.")
+        todo = list(enumerate(items))[::-1]
+        with cf.ProcessPoolExecutor(max_workers=numWorkers, initializer=self._initializer, initargs=self._initArgs) as pool:
+            running = {}
+            while len(todo) > 0 or len(running) > 0:
+                while len(todo) > 0 and len(running) < numWorkers:
+                    if len(running) > 0 and not self._hasRoomForJob():  # Always allow one job so that we can't stall.
+                        logger.debug(f"Memory is low, waiting with {len(running)} jobs running.")
+                        break
+                    idx, item = todo.pop()
+                    running[pool.submit(func, item)] = idx
+                done, _ = cf.wait(running, timeout=self.pollInterval, return_when=cf.FIRST_COMPLETED)
+                for future in done:
+                    yield running.pop(future), future.result()
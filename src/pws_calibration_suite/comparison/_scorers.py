@@ -1,16 +1,31 @@
 from __future__ import annotations
 import abc
 import dataclasses
+import enum
 import json
-import logging
+import threading
 import typing
 import numpy as np
-import scipy.signal as sps
-from skimage import measure
-from skimage import metrics
-from time import time
-from scipy.interpolate import interp1d
-from ._utility import DualCubeSplitter
+import scipy.fft as spfft
+from scipy import ndimage
+from . import instrumentation
+from ._utility import CubePairStatistics, applyToSlabs, defaultNumThreads
+
+
+class PreparedTemplate:
+    """
+    Holds a template array along with any quantities derived only from the template. A `Score` computes these once with
+    `Score.prepareTemplate` so that they can be reused for every test array that is compared against the same template.
+
+    Args:
+        data: A 3d array of reflectance data that test arrays will be compared against.
+    """
+    def __init__(self, data: np.ndarray):
+        self.data = data
+
+    def __getitem__(self, slc: typing.Tuple[slice, slice]) -> PreparedTemplate:
+        """Select a lateral region of the prepared template. `slc` should only index the first two (spatial) axes."""
+        return PreparedTemplate(self.data[slc])
 
 
 @dataclasses.dataclass
@@ -19,6 +34,9 @@ class Score(abc.ABC):
     Compares the 3d reflectance cube of the template with the reflectance cube of a test measurement.
     The test reflectance array should have already been transformed so that they are aligned.
 
+    Calculations are done in the floating point precision of the input arrays, no full-size upcast copies are made.
+    Only scalar accumulations are done in float64.
+
     Args:
         template: A 3d array of reflectance data that the test array will be compared against
         test: A 3d array to compare against the template array. Since it is likely that the original data will need to have been transformed
@@ -26,16 +44,93 @@ class Score(abc.ABC):
     """
     score: float  # This attribute will be inherited by all deriving classes. Should be a value between 0 and 1
 
+    version = 1  # Increment this in a scorer whenever a change to its code would change its results. Cached scores from older versions will then be recalculated.
+    preparedMemory = 0  # The approximate size of the arrays stored by `prepareTemplate`, in multiples of the size of the template array.
+    workingMemory = 0  # The approximate peak size of the temporary arrays allocated by `createFromPrepared`, in multiples of the size of the test array.
+
+    @classmethod
+    def cacheConfig(cls) -> typing.Dict[str, typing.Any]:
+        """The JSON serializable settings of this scorer that change its results. They are part of the key that
+        cached scores are stored under, so changing any of them causes cached scores to be recalculated."""
+        return {}
+
     @classmethod
-    @abc.abstractmethod
     def create(cls, template: np.ndarray, test: np.ndarray) -> Score:
         """
 
         Returns:
             A dictionary of scoring information including one value under the name 'score' which is between 0 and 1 indicating how well this scorer rates the match between the template and the test array.
         """
+        return cls.createFromPrepared(cls.prepareTemplate(template), test)
+
+    @classmethod
+    def createBatch(cls, template: np.ndarray, tests: typing.Iterable[np.ndarray]) -> typing.List[Score]:
+        """Score a series of test arrays against a single template. The template-side work is only done once.
+
+        Args:
+            template: A 3d array of reflectance data that the test arrays will be compared against
+            tests: An iterable of 3d arrays with the same shape as `template`.
+
+        Returns:
+            A list of scores in the same order as `tests`.
+        """
+        prepared = cls.prepareTemplate(template)
+        return [cls.createFromPrepared(prepared, test) for test in tests]
+
+    @classmethod
+    def prepareTemplate(cls, template: np.ndarray) -> PreparedTemplate:
+        """Compute any quantities that depend only on the template. Scorers with reusable template-side state override this."""
+        return PreparedTemplate(template)
+
+    @classmethod
+    def estimateMemory(cls, shape: typing.Tuple[int, ...], dtype: np.dtype) -> typing.Tuple[int, int]:
+        """Estimate the memory needed to score arrays of `shape` and `dtype`. Used to decide how much work can be run in parallel.
+
+        Returns:
+            The bytes used by a prepared template and the peak bytes of temporary arrays used while scoring a single test array.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return int(cls.preparedMemory * nbytes), int(cls.workingMemory * nbytes)
+
+    @classmethod
+    @abc.abstractmethod
+    def createFromPrepared(cls, template: PreparedTemplate, test: np.ndarray) -> Score:
+        """Equivalent to `create` but takes a template that was already processed by `prepareTemplate`."""
         pass
 
+    @classmethod
+    def createTiled(cls, template: PreparedTemplate, test: np.ndarray, tileShape: typing.Tuple[int, int], numThreads: int = None) -> np.ndarray:
+        """Score each tile of a lateral grid separately. The remainder pixels along the bottom and right edges that
+        don't fill a whole tile are left out. Scorers that can process all the tiles at once override this, by default
+        `_createTile` is called for each tile with the tile rows split across threads.
+
+        Args:
+            template: The template prepared from the whole array.
+            test: A 3d array with the same shape as the template.
+            tileShape: The number of (rows, columns) in each tile.
+            numThreads: The number of threads to use. If `None` then `defaultNumThreads()` is used.
+
+        Returns:
+            A 2d object array with the score of each tile.
+        """
+        gridShape = tuple(n // t for n, t in zip(test.shape[:2], tileShape))
+        out = np.empty(gridShape, dtype=object)
+
+        def scoreRows(tileRows: slice):
+            for i in range(tileRows.start, tileRows.stop):
+                for j in range(gridShape[1]):
+                    slc = (slice(i * tileShape[0], (i + 1) * tileShape[0]), slice(j * tileShape[1], (j + 1) * tileShape[1]))
+                    out[i, j] = cls._createTile(template[slc], test[slc])
+
+        applyToSlabs(scoreRows, gridShape[0], numThreads)
+        return out
+
+    @classmethod
+    def _createTile(cls, template: PreparedTemplate, test: np.ndarray) -> Score:
+        """Score a single tile for the default `createTiled`. This is run on one of the tile threads so scorers that
+        use threads of their own in `createFromPrepared` override this to run single threaded."""
+        return cls.createFromPrepared(template, test)
+
     @classmethod
     def fromJson(cls, jsonStr: str):
         import dacite  # This is iffy. only way right now to load nested dataclasses from json.
@@ -57,28 +152,172 @@ class Score(abc.ABC):
                 return super().default(obj)
 
 
+class _LateralPreparedTemplate(PreparedTemplate):
+    """Stores the normalized middle-wavelength image of the template for `LateralXCorrScore`. The FFTs of the image
+    are cached for each padded shape and lateral regions are cached for each slice, so measurements that share the
+    same valid region reuse the same template FFT."""
+    maxCachedRegions = 8  # The number of sliced regions (and their FFTs) that are kept. The least recently used region is dropped first.
+
+    def __init__(self, data: np.ndarray):
+        super().__init__(data)
+        # Select a single wavelength image from the middle of the array.
+        image = data[:, :, data.shape[2]//2]
+        # Normalize Data. Correlation will pad with 0s so make sure the mean of the data is 0
+        self.image = (image - image.mean()) / image.std()
+        self._spectra = {}
+        self._regions: typing.Dict[tuple, _LateralPreparedTemplate] = {}
+        self._lock = threading.Lock()  # Measurements may be scored on several threads at once.
+
+    def __getitem__(self, slc: typing.Tuple[slice, slice]) -> _LateralPreparedTemplate:
+        key = tuple(s.indices(n) for s, n in zip(slc, self.data.shape))  # `slice` objects aren't hashable before Python 3.12.
+        with self._lock:
+            region = self._regions.pop(key, None)
+            if region is None:
+                region = _LateralPreparedTemplate(self.data[slc])  # The normalization depends on the selected region so it must be redone.
+            self._regions[key] = region  # Move to the end, the dict is kept in order of use.
+            while len(self._regions) > self.maxCachedRegions:
+                del self._regions[next(iter(self._regions))]
+        return region
+
+    def spectrum(self, fftShape: typing.Tuple[int, int]) -> np.ndarray:
+        """The real 2d FFT of the normalized image after zero-padding to `fftShape`. Cached for each padded shape."""
+        if fftShape not in self._spectra:
+            self._spectra[fftShape] = spfft.rfft2(self.image, s=fftShape)
+        return self._spectra[fftShape]
+
+
 @dataclasses.dataclass
 class LateralXCorrScore(Score):
-    shift: list
+    shift: list  # The subpixel (y, x) shift of the test image relative to the template.
     cdrY: float
     cdrX: float
+    cdrMajor: typing.Optional[float] = None  # The fastest decay rate of the correlation peak in any direction. Found from the quadratic fit of the peak, see `_fitCDREllipse`.
+    cdrMinor: typing.Optional[float] = None  # The slowest decay rate of the correlation peak. Perpendicular to the direction of `cdrMajor`.
+    cdrAngle: typing.Optional[float] = None  # The angle (radians, from the +X axis towards +Y) of the direction with the fastest decay. Between -pi/2 and pi/2.
+
+    version = 2
+    lagWindow = 16  # The cross-correlation is only evaluated for shifts of up to this many pixels along each axis. The window is automatically enlarged if the peak lands too close to its edge.
+    _cdrInterval = 3  # The pixel offset from the correlation peak used to measure the correlation decay rate (CDR).
+
+    @classmethod
+    def cacheConfig(cls) -> typing.Dict[str, typing.Any]:
+        return {'lagWindow': cls.lagWindow, 'cdrInterval': cls._cdrInterval}
 
     @classmethod
-    def create(cls, tempData: np.ndarray, testData: np.ndarray) -> Score:
+    def prepareTemplate(cls, template: np.ndarray) -> _LateralPreparedTemplate:
+        return _LateralPreparedTemplate(template)
+
+    @classmethod
+    def createFromPrepared(cls, template: _LateralPreparedTemplate, testData: np.ndarray) -> LateralXCorrScore:
+        tempData = template.image
         # Select a single wavelength image from the middle of the array.
-        tempData = tempData[:, :, tempData.shape[2]//2]
         testData = testData[:, :, testData.shape[2]//2]
 
         # Normalize Data. Correlation will pad with 0s so make sure the mean of the data is 0
-        tempData = (tempData - tempData.mean()) / tempData.std()
         testData = (testData - testData.mean()) / (testData.std() * testData.size)  # The division by testData.size here gives us a final xcorrelation that maxes out at 1.
-        corr = sps.correlate(tempData, testData, mode='full')  # Using 'full' here instead of 'same' means that we can reliably know the index of the zero-shift element of the output
-        zeroShiftIdx = (corr.shape[0]//2, corr.shape[1]//2)
-        peakIdx = np.unravel_index(corr.argmax(), corr.shape)
-        cdrY, cdrX = cls._calculate2DCDR(corr, peakIdx, 3)
-        # plt.imshow(corr, cmap='jet', extent=(-np.floor(corr.shape[0]/2), np.floor(corr.shape[0]/2), -np.floor(corr.shape[1]/2), np.floor(corr.shape[1]/2)))
-        # plt.xlim([-5, 5]); plt.ylim([-5, 5])
-        return cls(**{'score': float(corr.max()), 'shift': (peakIdx[0]-zeroShiftIdx[0], peakIdx[1]-zeroShiftIdx[1]), 'cdrY': cdrY, 'cdrX': cdrX})
+        lagWindow = cls.lagWindow
+        fullWindow = tuple(n - 1 for n in tempData.shape)
+        while True:
+            corr, zeroShiftIdx = cls._windowedCorrelate(template.spectrum, testData, lagWindow)
+            peakIdx = np.unravel_index(corr.argmax(), corr.shape)
+            if cls._isPeakMeasurable(peakIdx, corr.shape) or zeroShiftIdx == fullWindow:
+                break
+            lagWindow *= 2  # The peak is too close to the edge of the window to measure the CDR. Try again with a larger window.
+        # plt.imshow(corr, cmap='jet', extent=(-zeroShiftIdx[1], zeroShiftIdx[1], -zeroShiftIdx[0], zeroShiftIdx[0]))
+        return cls._fromCorrelation(corr, peakIdx, zeroShiftIdx)
+
+    @classmethod
+    def createTiled(cls, template: PreparedTemplate, testData: np.ndarray, tileShape: typing.Tuple[int, int], numThreads: int = None) -> np.ndarray:
+        """The middle-wavelength images of all the tiles are stacked along a new first axis and correlated with FFTs that
+        are batched over the tiles. Only the tiles whose peak lands too close to the edge of the lag window are correlated
+        again with a larger window."""
+        gridShape = tuple(n // t for n, t in zip(testData.shape[:2], tileShape))
+
+        def toTiles(arr: np.ndarray) -> np.ndarray:
+            image = arr[:gridShape[0] * tileShape[0], :gridShape[1] * tileShape[1], arr.shape[2]//2]
+            return image.reshape(gridShape[0], tileShape[0], gridShape[1], tileShape[1]).swapaxes(1, 2).reshape((-1,) + tuple(tileShape))
+
+        tempImages, testImages = toTiles(template.data), toTiles(testData)
+        tempImages = (tempImages - tempImages.mean(axis=(1, 2), keepdims=True)) / tempImages.std(axis=(1, 2), keepdims=True)
+        testImages = (testImages - testImages.mean(axis=(1, 2), keepdims=True)) / (testImages.std(axis=(1, 2), keepdims=True) * testImages[0].size)
+        out = np.empty(tempImages.shape[0], dtype=object)
+        remaining = np.arange(tempImages.shape[0])
+        lagWindow = cls.lagWindow
+        fullWindow = tuple(n - 1 for n in tileShape)
+        while len(remaining) > 0:
+            spectrum = lambda fftShape: spfft.rfft2(tempImages[remaining], s=fftShape, workers=numThreads)
+            corrs, zeroShiftIdx = cls._windowedCorrelate(spectrum, testImages[remaining], lagWindow, numThreads)
+            done = np.zeros(len(remaining), dtype=bool)
+            for k, corr in enumerate(corrs):
+                peakIdx = np.unravel_index(corr.argmax(), corr.shape)
+                if cls._isPeakMeasurable(peakIdx, corr.shape) or zeroShiftIdx == fullWindow:
+                    out[remaining[k]] = cls._fromCorrelation(corr, peakIdx, zeroShiftIdx)
+                    done[k] = True
+            remaining = remaining[~done]
+            lagWindow *= 2
+        return out.reshape(gridShape)
+
+    @classmethod
+    def _isPeakMeasurable(cls, peakIdx: typing.Tuple[int, int], corrShape: typing.Tuple[int, int]) -> bool:
+        """Returns `True` if the peak is far enough from the edge of the correlation to measure the CDR."""
+        return all(cls._cdrInterval <= p < n - cls._cdrInterval for p, n in zip(peakIdx, corrShape))
+
+    @classmethod
+    def _fromCorrelation(cls, corr: np.ndarray, peakIdx: typing.Tuple[int, int], zeroShiftIdx: typing.Tuple[int, int]) -> LateralXCorrScore:
+        cdrY, cdrX = cls._calculate2DCDR(corr, peakIdx, cls._cdrInterval)
+        cdrMajor, cdrMinor, cdrAngle = cls._fitCDREllipse(corr, peakIdx, cls._cdrInterval)
+        shift = [peakIdx[i] - zeroShiftIdx[i] + cls._subpixelOffset(corr, peakIdx, axis=i) for i in range(2)]
+        return cls(**{'score': float(corr[peakIdx]), 'shift': shift, 'cdrY': cdrY, 'cdrX': cdrX,
+                      'cdrMajor': cdrMajor, 'cdrMinor': cdrMinor, 'cdrAngle': cdrAngle})
+
+    @property
+    def cdrEccentricity(self) -> typing.Optional[float]:
+        """The eccentricity of the ellipses of constant correlation around the peak. 0 for a circularly symmetric peak."""
+        if self.cdrMajor is None:
+            return None
+        return float(np.sqrt(1 - np.clip(self.cdrMinor / self.cdrMajor, 0, 1)))
+
+    @staticmethod
+    def _windowedCorrelate(tempSpectrum: typing.Callable[[typing.Tuple[int, int]], np.ndarray], testData: np.ndarray, lagWindow: int,
+                           workers: int = None) -> typing.Tuple[np.ndarray, typing.Tuple[int, int]]:
+        """Cross correlate the template image with `testData` using FFTs. Zero-padding each axis by `lagWindow` is enough
+        to prevent circular wrap-around for the shifts that we keep, which is much cheaper than computing the 'full' correlation.
+
+        Args:
+            tempSpectrum: A function that returns the real 2d FFT of the normalized template image zero-padded to the shape it is given.
+            testData: A normalized 2d image with the same shape as the template. May also be a stack of images along
+                the first axis in which case each image is correlated separately.
+            lagWindow: The maximum shift (in pixels) to evaluate along each axis. Limited to the size of the image.
+            workers: The number of threads used by each FFT.
+
+        Returns:
+            A tuple of the cross-correlation for shifts from -`lagWindow` to +`lagWindow` and the index of the zero-shift element.
+        """
+        imShape = testData.shape[-2:]
+        windows = tuple(min(lagWindow, n - 1) for n in imShape)
+        fftShape = tuple(spfft.next_fast_len(n + w, real=True) for n, w in zip(imShape, windows))
+        corr = spfft.irfft2(tempSpectrum(fftShape) * spfft.rfft2(testData, s=fftShape, workers=workers).conj(), s=fftShape, workers=workers)
+        # Negative shifts wrap around to the end of the circular correlation. Indexing with negative numbers puts them in front of the non-negative shifts.
+        corr = corr[..., np.arange(-windows[0], windows[0] + 1)[:, None], np.arange(-windows[1], windows[1] + 1)[None, :]]
+        return corr, windows
+
+    @staticmethod
+    def _subpixelOffset(corr: np.ndarray, peakIdx: typing.Tuple[int, ...], axis: int) -> float:
+        """Refine the location of the correlation peak along `axis` by fitting a parabola through the peak and its two neighbors.
+
+        Returns:
+            The offset (between -0.5 and 0.5) from `peakIdx` to the vertex of the parabola.
+        """
+        if not 0 < peakIdx[axis] < corr.shape[axis] - 1:
+            return 0.
+        before, after = list(peakIdx), list(peakIdx)
+        before[axis] -= 1
+        after[axis] += 1
+        before, peak, after = corr[tuple(before)], corr[peakIdx], corr[tuple(after)]
+        curvature = before - 2 * peak + after
+        if curvature == 0:
+            return 0.
+        return float((before - after) / (2 * curvature))
 
     @staticmethod
     def _calculate2DCDR(corr: np.ndarray, peakIdx: typing.Tuple[int, int], interval: int) -> typing.Tuple[float, float]:
@@ -95,16 +334,42 @@ class LateralXCorrScore(Score):
         return cdrY, cdrX
 
     @staticmethod
-    def fitCDR(corr: np.ndarray, peakIdx: typing.Tuple[int, int]): #TODO finish this
-        def poly(xidx, yidx, val, angleRads, eccent, majorlinear, minorlinear, majorquadratic, minorquadratic):
-            pass
+    def _fitCDREllipse(corr: np.ndarray, peakIdx: typing.Tuple[int, int], interval: int) -> typing.Tuple[float, float, float]:
+        """Fit a 2d quadratic to the correlation within `interval` pixels of the peak with linear least squares. The
+        quadratic part of the fit gives the decay rate of the peak in every direction, the directions of fastest and
+        slowest decay are the principal axes of the ellipses of constant correlation. Only the small window around the
+        peak is used so this is cheap even for large correlations.
 
-        threshold = -1.5
-        corr = corr / corr[peakIdx]  # Normalize by peak correlation (corrPeak = 1)
-        corr = np.log10(corr)
-        mask = corr >= threshold  # A mask of pixels with corrrelation (log10) above -1.5
-        labeled = measure.label(mask)
-        mask = labeled == labeled[peakIdx]  # A mask containing only the pixels connected to the peak correlation
+        Returns:
+            A tuple of the fastest decay rate, the slowest decay rate and the angle (radians, from the +X axis towards +Y)
+            of the direction of fastest decay. Decay rates are scaled to match `_calculate2DCDR` for a quadratic peak.
+        """
+        window = tuple(slice(max(0, p - interval), min(n, p + interval + 1)) for p, n in zip(peakIdx, corr.shape))
+        y, x = np.mgrid[window]
+        y, x = (y - peakIdx[0]).ravel(), (x - peakIdx[1]).ravel()
+        values = corr[window].ravel() / corr[peakIdx]  # Normalize so that peak correlation is 1.
+        design = np.stack([np.ones_like(y), y, x, y**2, y * x, x**2], axis=1)
+        coeffs = np.linalg.lstsq(design, values, rcond=None)[0]
+        # Moving `r` pixels along the unit vector `v` from the vertex the fit drops by `r**2 * v.T @ decay @ v`
+        decay = -np.array([[coeffs[3], coeffs[4] / 2], [coeffs[4] / 2, coeffs[5]]])
+        rates, axes = np.linalg.eigh(decay)  # Sorted from slowest to fastest
+        angle = np.arctan2(axes[0, 1], axes[1, 1])
+        angle = (angle + np.pi / 2) % np.pi - np.pi / 2  # An axis has no direction so fold the angle into [-pi/2, pi/2)
+        # `_calculate2DCDR` averages the drop over `interval` pixels divided by `interval`
+        return float(rates[1] * interval), float(rates[0] * interval), float(angle)
+
+
+class _AxialPreparedTemplate(PreparedTemplate):
+    """Stores the template for `AxialXCorrScore` with each XY pixel normalized to mean=0, stddev=1. Since the normalization
+    is done independently for each pixel it remains valid after lateral slicing."""
+    def __init__(self, data: np.ndarray, normalized: np.ndarray = None):
+        super().__init__(data)
+        if normalized is None:
+            normalized = (data - data.mean(axis=2)[:, :, None]) / data.std(axis=2)[:, :, None]
+        self.normalized = normalized
+
+    def __getitem__(self, slc: typing.Tuple[slice, slice]) -> _AxialPreparedTemplate:
+        return _AxialPreparedTemplate(self.data[slc], self.normalized[slc])
 
 
 @dataclasses.dataclass
@@ -112,33 +377,103 @@ class AxialXCorrScore(Score):
     shift: float
     cdr: float
 
+    class ShiftEstimator(enum.Enum):
+        DFT = "Interpolates the correlation peak with a matrix multiplied inverse DFT. Resolution is set by `shiftPrecision`."
+        PARABOLIC = "Fits a parabola to the correlation peak and its two neighbors. Very fast but biased for broad peaks."
+
+    memoryBudget = 256 * 2**20  # The approximate number of bytes of temporary arrays that may be allocated at once while correlating the cubes.
+    preparedMemory = 1
+    shiftEstimator = ShiftEstimator.DFT  # Selects how the subpixel `shift` is found.
+    shiftPrecision = 0.1  # The spacing (in pixels) of the shifts that are tested when using the `DFT` shift estimator.
+
+    @classmethod
+    def prepareTemplate(cls, template: np.ndarray) -> _AxialPreparedTemplate:
+        return _AxialPreparedTemplate(template)
+
     @classmethod
-    def create(cls, tempData: np.ndarray, testData: np.ndarray) -> AxialXCorrScore:
-        # Normalize Each XY pixel to mean=0, stddev=1 so that the xcorrelation has a max of 1.
-        tempData = (tempData - tempData.mean(axis=2)[:, :, None]) / tempData.std(axis=2)[:, :, None]
-        testData = (testData - testData.mean(axis=2)[:, :, None]) / testData.std(axis=2)[:, :, None]
+    def cacheConfig(cls) -> typing.Dict[str, typing.Any]:
+        return {'shiftEstimator': cls.shiftEstimator.name, 'shiftPrecision': cls.shiftPrecision}
+
+    @classmethod
+    def estimateMemory(cls, shape: typing.Tuple[int, ...], dtype: np.dtype) -> typing.Tuple[int, int]:
+        prepared, working = super().estimateMemory(shape, dtype)
+        return prepared, working + cls.memoryBudget
+
+    @classmethod
+    def createFromPrepared(cls, template: _AxialPreparedTemplate, testData: np.ndarray) -> AxialXCorrScore:
         # Cross correlate the whole array with no upsampling for some metrics without getting huge RAM usage.
-        corr = cls._crossCorrelate(tempData, testData, upsampleFactor=1, axis=2)
-        corr = corr.mean(axis=(0, 1))
+        corr, tempMean, testMean = cls._streamTileCorrelations(template.normalized, testData, testData.shape[:2], numThreads=1)
+        return cls._fromCorrelation(corr[0, 0], tempMean[0, 0], testMean[0, 0])
+
+    @classmethod
+    def createTiled(cls, template: _AxialPreparedTemplate, testData: np.ndarray, tileShape: typing.Tuple[int, int], numThreads: int = None) -> np.ndarray:
+        """The cross-spectra of all the tiles in a row of tiles are accumulated together with a single FFT call and the
+        rows of tiles are split across threads."""
+        corr, tempMean, testMean = cls._streamTileCorrelations(template.normalized, testData, tileShape, numThreads)
+        out = np.empty(corr.shape[:2], dtype=object)
+        for idx in np.ndindex(out.shape):
+            out[idx] = cls._fromCorrelation(corr[idx], tempMean[idx], testMean[idx])
+        return out
+
+    @classmethod
+    def _fromCorrelation(cls, corr: np.ndarray, tempMean: np.ndarray, testMean: np.ndarray) -> AxialXCorrScore:
         peakIdx = corr.argmax()
         cdr = cls._calculate1DCDR(corr, peakIdx, 2)
         maxCorr = float(corr.max())
-        # Condense down to the average spectrum (1d) and then cross-correlate with upsampling to get a high resolution idea of the spectral shift.
-        upsampleFactor = 10
-        corr = cls._crossCorrelate(tempData.mean(axis=(0, 1)), testData.mean(axis=(0, 1)),
-                                   upsampleFactor=upsampleFactor, axis=0)
-        zeroShiftIdx = corr.shape[0]//2
-        peakIdx = corr.argmax()
-        shift = (peakIdx-zeroShiftIdx) / upsampleFactor  # Measured in pixels (before upsampling) pixels will be determined by the wavelength settings of acquisition.
+        # Use the average spectra (1d) to get a high resolution idea of the spectral shift.
+        shift = cls._estimateShift(tempMean, testMean)
         return cls(**{'score': maxCorr, 'shift': shift, 'cdr': float(cdr)})
 
-    @staticmethod
-    def _reverse_and_conj(x, axis=-1):
-        """
-        Reverse array `x` in all dimensions and perform the complex conjugate.
-        Copied from scipy.signal, This makes a convolution effectively a correlation. Modified to only effect the 2nd axis
+    @classmethod
+    def _streamTileCorrelations(cls, tempData: np.ndarray, testData: np.ndarray, tileShape: typing.Tuple[int, int],
+                                numThreads: int = None) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find the spectral cross-correlation of each XY pixel averaged over all pixels of each lateral tile without
+        holding the full 3d correlation in memory. The cubes are processed in chunks of rows sized so that all threads
+        together fit in `memoryBudget`. Since the average of the correlations equals the inverse FFT of the average
+        cross-spectrum only a 1d cross-spectrum per tile needs to be accumulated between chunks.
+
+        Args:
+            tempData: The template with each XY pixel already normalized to mean=0, stddev=1.
+            testData: The test array with the same shape as `tempData`. Will be normalized one chunk at a time.
+            tileShape: The number of (rows, columns) in each tile. Remainder pixels that don't fill a whole tile are left out.
+            numThreads: The number of threads that the rows of tiles are split between. If `None` then `defaultNumThreads()` is used.
+
+        Returns:
+            A tuple of: The average cross-correlation, the average normalized template spectrum and the average
+            normalized test spectrum. Each has a leading (rows, columns) axis for the grid of tiles. The correlation is
+            of length (2*N)-1 with the middle element corresponding to no shift.
         """
-        return np.flip(x, axis=axis).conj()
+        N = tempData.shape[2]
+        gridShape = tuple(n // t for n, t in zip(tempData.shape[:2], tileShape))
+        width = gridShape[1] * tileShape[1]
+        fftLen = spfft.next_fast_len(2 * N - 1, real=True)  # Long enough that the circular correlation doesn't wrap around.
+        itemSize = np.result_type(tempData, testData).itemsize
+        bytesPerPixel = itemSize * (3 * N + 6 * (fftLen // 2 + 1))  # The normalized test chunk, the two spectra and their product.
+        concurrentRows = min(gridShape[0], numThreads or defaultNumThreads())
+        rowsPerChunk = max(1, cls.memoryBudget // (bytesPerPixel * width * concurrentRows))
+        crossSpectra = np.zeros(gridShape + (fftLen // 2 + 1,), dtype=np.complex128)
+        tempSums = np.zeros(gridShape + (N,))
+        testSums = np.zeros(gridShape + (N,))
+
+        def accumulate(tileRows: slice):
+            for i in range(tileRows.start, tileRows.stop):
+                for start in range(i * tileShape[0], (i + 1) * tileShape[0], rowsPerChunk):
+                    stop = min(start + rowsPerChunk, (i + 1) * tileShape[0])
+                    tileView = (stop - start, gridShape[1], tileShape[1], -1)  # Splits the columns into tiles.
+                    tempChunk = tempData[start:stop, :width]
+                    testChunk = testData[start:stop, :width]
+                    # Normalize Each XY pixel to mean=0, stddev=1 so that the xcorrelation has a max of 1.
+                    testChunk = (testChunk - testChunk.mean(axis=2)[:, :, None]) / testChunk.std(axis=2)[:, :, None]
+                    product = spfft.rfft(tempChunk, n=fftLen, axis=2) * spfft.rfft(testChunk, n=fftLen, axis=2).conj()
+                    crossSpectra[i] += product.reshape(tileView).sum(axis=(0, 2))
+                    tempSums[i] += tempChunk.reshape(tileView).sum(axis=(0, 2))
+                    testSums[i] += testChunk.reshape(tileView).sum(axis=(0, 2))
+
+        applyToSlabs(accumulate, gridShape[0], numThreads)
+        numPixels = tileShape[0] * tileShape[1]
+        corr = spfft.irfft(crossSpectra, n=fftLen, axis=-1) / (N * numPixels)  # The division by N here gives us a final xcorrelation that maxes out at 1.
+        corr = corr[..., np.arange(-(N - 1), N)]  # Negative shifts wrap around to the end of the circular correlation.
+        return corr, tempSums / numPixels, testSums / numPixels
 
     @staticmethod
     def _calculate1DCDR(corr: np.ndarray, peakIdx: int, interval: int) -> float:
@@ -148,45 +483,165 @@ class AxialXCorrScore(Score):
         return (cdr2 + cdr1) / 2  # Take the average of the cdr in each direction
 
     @classmethod
-    def _crossCorrelate(cls, arr1: np.ndarray, arr2: np.ndarray, upsampleFactor: int = 1, axis: int = -1) -> np.ndarray:
-        """Cross correlate arr1 with arr2 along one axis.
+    def _estimateShift(cls, tempSpectrum: np.ndarray, testSpectrum: np.ndarray) -> float:
+        """Estimate the subpixel shift between two 1d spectra from the peak of their cross-correlation.
 
         Args:
-            arr1: A numpy array to use in the cross-correlation
-            arr2: A numpy array with the same shape as `arr1` to be cross-correlated with `arr1`
-            upsampleFactor: In order to improve the resolution when looking at shift between the two arrays, the arrays
-                can be upsampled along their last axis with cubic interpolation before the cross-correlation
-            axis: The axis to correlate along.
+            tempSpectrum: The average normalized spectrum of the template.
+            testSpectrum: The average normalized spectrum of the test array.
 
         Returns:
-            The cross-correlation result. The correlation axis will be of length (2*N)-1, where N is the length of the
-            input arrays along that same axis. The middle element corresponds to the correlation with no shift between
-            the two input arrays.
+            The shift measured in pixels. Pixels will be determined by the wavelength settings of acquisition.
         """
-        if upsampleFactor != 1:
-            x = np.linspace(0, 1, num=arr1.shape[axis])
-            x2 = np.linspace(0, 1, num=arr1.shape[axis] * upsampleFactor)
-            arr1 = interp1d(x, arr1, axis=axis, kind='cubic')(x2)
-            arr2 = interp1d(x, arr2, axis=axis, kind='cubic')(x2)
-        # Very hard to find support for 1d correlation on an Nd array. scipy.signal.fftconvolve appears to be the best option
-        scaledArr2 = arr2 / arr2.shape[axis]  # The division by testData.size here gives us a final xcorrelation that maxes out at 1.
-        corr = sps.fftconvolve(arr1, cls._reverse_and_conj(scaledArr2, axis=axis), axes=axis, mode='full')
-        return corr
+        N = tempSpectrum.shape[0]
+        fftLen = spfft.next_fast_len(2 * N - 1)  # Long enough that the circular correlation doesn't wrap around.
+        crossSpectrum = spfft.fft(tempSpectrum, n=fftLen) * spfft.fft(testSpectrum, n=fftLen).conj()
+        corr = spfft.ifft(crossSpectrum).real
+        lags = np.arange(-(N - 1), N)
+        corr = corr[lags]  # Negative shifts wrap around to the end of the circular correlation.
+        peakIdx = corr.argmax()
+        if not 0 < peakIdx < corr.shape[0] - 1:
+            return float(lags[peakIdx])  # There is nothing to refine on the edge of the correlation.
+        if cls.shiftEstimator == AxialXCorrScore.ShiftEstimator.PARABOLIC:
+            before, peak, after = corr[peakIdx - 1:peakIdx + 2]
+            return float(lags[peakIdx] + (before - after) / (2 * (before - 2 * peak + after)))
+        elif cls.shiftEstimator == AxialXCorrScore.ShiftEstimator.DFT:
+            # Evaluating the inverse DFT at non-integer shifts is equivalent to zero-padding the cross-spectrum, but
+            # we only pay for the shifts within one pixel of the integer peak.
+            steps = int(round(1 / cls.shiftPrecision))
+            shifts = lags[peakIdx] + np.arange(-steps, steps + 1) * cls.shiftPrecision
+            freqs = spfft.fftfreq(fftLen)
+            upsampled = (np.exp(2j * np.pi * np.outer(shifts, freqs)) @ crossSpectrum).real
+            return float(shifts[upsampled.argmax()])
+        else:
+            raise ValueError(f"AxialXCorrScore shift estimator {cls.shiftEstimator} is not supported.")
+
+
+class _SSimPreparedTemplate(PreparedTemplate):
+    """Stores the template for `SSimScore` along with its gaussian weighted local mean and local mean of squares.
+    Lateral slicing of these maps gives the same values as filtering the sliced template everywhere except for a border
+    of width `SSimScore._filterRadius()`, which is cropped out of the final SSIM score anyway."""
+    def __init__(self, data: np.ndarray, ux: np.ndarray = None, uxx: np.ndarray = None):
+        super().__init__(data)
+        if ux is None:
+            ux = SSimScore._filter(data)
+            uxx = SSimScore._filter(data, data)
+        self.ux = ux
+        self.uxx = uxx
+
+    def __getitem__(self, slc: typing.Tuple[slice, slice]) -> _SSimPreparedTemplate:
+        return _SSimPreparedTemplate(self.data[slc], self.ux[slc], self.uxx[slc])
+
 
 @dataclasses.dataclass
 class SSimScore(Score):
+    """
+    The mean structural similarity index of the two arrays. This matches `skimage.metrics.structural_similarity` with
+    `gaussian_weights=True, sigma=1.5, data_range=2`, which matches the implementation of Wang et. al. Calculations are
+    done in float32 (unless the inputs are float64) so the score differs from the float64 `skimage` result by up to
+    about 1e-6.
+    """
+    _sigma = 1.5
+    _truncate = 3.5
+    _K1 = 0.01
+    _K2 = 0.03
+    _dataRange = 2  # Older versions of `skimage` used the range of the floating point dtype (-1 to 1) when `data_range` was not provided.
+    numThreads = None  # The number of threads used for filtering. If `None` then `defaultNumThreads()` is used.
+    preparedMemory = 2  # `ux` and `uxx`
+    workingMemory = 4  # `uy`, `uyy`, `uxy` and the product that is filtered.
+
     @classmethod
-    def create(cls, tempData: np.ndarray, testData: np.ndarray) -> SSimScore:
-        score = float(metrics.structural_similarity(tempData, testData, gaussian_weights=True, sigma=1.5))  # The parameters here are meant to make the implementation match that of Wang et. al
+    def cacheConfig(cls) -> typing.Dict[str, typing.Any]:
+        return {'sigma': cls._sigma, 'truncate': cls._truncate, 'K1': cls._K1, 'K2': cls._K2, 'dataRange': cls._dataRange}
+
+    @classmethod
+    def prepareTemplate(cls, template: np.ndarray) -> _SSimPreparedTemplate:
+        return _SSimPreparedTemplate(template)
+
+    @classmethod
+    def createFromPrepared(cls, template: _SSimPreparedTemplate, testData: np.ndarray) -> SSimScore:
+        return cls._score(template, testData, cls.numThreads)
+
+    @classmethod
+    def _createTile(cls, template: _SSimPreparedTemplate, testData: np.ndarray) -> SSimScore:
+        return cls._score(template, testData, numThreads=1)  # The tiles are already split across threads.
+
+    @classmethod
+    def _score(cls, template: _SSimPreparedTemplate, testData: np.ndarray, numThreads: typing.Optional[int]) -> SSimScore:
+        ux, uxx = template.ux, template.uxx
+        uy = cls._filter(testData, numThreads=numThreads)
+        uyy = cls._filter(testData, testData, numThreads=numThreads)
+        uxy = cls._filter(template.data, testData, numThreads=numThreads)
+        pad = cls._filterRadius()  # To avoid edge effects we ignore the filter radius strip around the edges.
+        NP = (2 * pad + 1) ** testData.ndim
+        covNorm = NP / (NP - 1)  # sample covariance
+        C1 = (cls._K1 * cls._dataRange) ** 2
+        C2 = (cls._K2 * cls._dataRange) ** 2
+        lateralCrop = tuple(slice(pad, n - pad) for n in testData.shape[:2])
+
+        def slabSum(slc: slice) -> float:
+            slc = lateralCrop + (slice(slc.start + pad, slc.stop + pad),)
+            x, y = ux[slc], uy[slc]
+            vx = covNorm * (uxx[slc] - x * x)
+            vy = covNorm * (uyy[slc] - y * y)
+            vxy = covNorm * (uxy[slc] - x * y)
+            S = ((2 * x * y + C1) * (2 * vxy + C2)) / ((x * x + y * y + C1) * (vx + vy + C2))
+            return S.sum(dtype=np.float64)
+
+        # Combine the maps one slab of wavelengths at a time so that the temporaries are small.
+        numWavelengths = testData.shape[2] - 2 * pad
+        total = sum(applyToSlabs(slabSum, numWavelengths, numThreads))
+        score = float(total / (numWavelengths * (testData.shape[0] - 2 * pad) * (testData.shape[1] - 2 * pad)))
         assert not np.isnan(score), "NaN value found in SSimScorer"
         return cls(score=score)
 
+    @classmethod
+    def _filterRadius(cls) -> int:
+        return int(cls._truncate * cls._sigma + 0.5)  # radius as in ndimage
+
+    @classmethod
+    def _filter(cls, arr: np.ndarray, arr2: np.ndarray = None, numThreads: int = None) -> np.ndarray:
+        """Apply a 3d gaussian filter one axis at a time. The two lateral passes are split across threads by
+        wavelength and the spectral pass is split by rows.
+
+        Args:
+            arr: The 3d array to filter.
+            arr2: If provided then the product of `arr` and `arr2` is filtered. The product is only formed one slab at a time.
+            numThreads: The number of threads to use. If `None` then `numThreads` of the class is used.
+
+        Returns:
+            A new array with the filtered data. float32 unless the inputs are float64.
+        """
+        dtype = np.result_type(arr, np.float32) if arr2 is None else np.result_type(arr, arr2, np.float32)
+        out = np.empty(arr.shape, dtype=dtype)
+        kwargs = dict(sigma=cls._sigma, truncate=cls._truncate, mode='reflect')
+
+        def lateral(slc: slice):
+            slab = arr[:, :, slc].astype(dtype, copy=False)
+            if arr2 is not None:
+                slab = slab * arr2[:, :, slc].astype(dtype, copy=False)
+            ndimage.gaussian_filter1d(slab, axis=0, output=out[:, :, slc], **kwargs)
+            ndimage.gaussian_filter1d(out[:, :, slc], axis=1, output=out[:, :, slc], **kwargs)
+
+        def spectral(slc: slice):
+            ndimage.gaussian_filter1d(out[slc], axis=2, output=out[slc], **kwargs)
+
+        numThreads = cls.numThreads if numThreads is None else numThreads
+        applyToSlabs(lateral, arr.shape[2], numThreads)
+        applyToSlabs(spectral, arr.shape[0], numThreads)
+        return out
+
 
 @dataclasses.dataclass
 class RMSEScore(Score):
     @classmethod
-    def create(cls, tempData: np.ndarray, testData: np.ndarray) -> RMSEScore:
-        nrmse = metrics.normalized_root_mse(tempData, testData, normalization='euclidean')
+    def createFromPrepared(cls, template: PreparedTemplate, testData: np.ndarray) -> RMSEScore:
+        return cls.fromStatistics(CubePairStatistics.compute(template.data, testData))
+
+    @classmethod
+    def fromStatistics(cls, stats: CubePairStatistics) -> RMSEScore:
+        """Create the score from statistics that have already been calculated for the template and test arrays."""
+        nrmse = stats.normalizedRMSE
         assert not np.isnan(nrmse), "NaN value found in RMSEScorer"
         return cls(score=1 - nrmse)
 
@@ -196,45 +651,159 @@ class ReflectanceScorer(Score):
     reflectanceRatio: float
 
     @classmethod
-    def create(cls, tempData: np.ndarray, testData: np.ndarray) -> ReflectanceScorer:
-        meanReflectanceRatio = float(np.mean(testData / tempData))
+    def createFromPrepared(cls, template: PreparedTemplate, testData: np.ndarray) -> ReflectanceScorer:
+        return cls.fromStatistics(CubePairStatistics.compute(template.data, testData))
+
+    @classmethod
+    def fromStatistics(cls, stats: CubePairStatistics) -> ReflectanceScorer:
+        """Create the score from statistics that have already been calculated for the template and test arrays."""
+        meanReflectanceRatio = stats.meanRatio
         score = 1 - np.abs(1-meanReflectanceRatio)
         return cls(score=score, reflectanceRatio=meanReflectanceRatio)
 
 
+class _CombinedPreparedTemplate(PreparedTemplate):
+    """Stores the prepared templates of each of the scorers used by `CombinedScore`.
+
+    Args:
+        data: The 3d template array.
+        subTemplates: The prepared templates keyed by the name of the field of `CombinedScore` that they are used for.
+    """
+    def __init__(self, data: np.ndarray, subTemplates: typing.Dict[str, PreparedTemplate]):
+        super().__init__(data)
+        self.subTemplates = subTemplates
+
+    def __getitem__(self, slc: typing.Tuple[slice, slice]) -> _CombinedPreparedTemplate:
+        return _CombinedPreparedTemplate(self.data[slc], {k: v[slc] for k, v in self.subTemplates.items()})
+
+    def select(self, scorers: typing.Sequence[str]) -> _CombinedPreparedTemplate:
+        """Get a prepared template that will only calculate the sub-scores named in `scorers`."""
+        return _CombinedPreparedTemplate(self.data, {k: v for k, v in self.subTemplates.items() if k in scorers})
+
+
 @dataclasses.dataclass
 class CombinedScore(Score):
-    nrmse: RMSEScore
-    latxcorr: LateralXCorrScore
-    ssim: SSimScore
-    axxcorr: AxialXCorrScore
-    reflectance: ReflectanceScorer
-
-    @classmethod
-    def create(cls, template: np.ndarray, test: np.ndarray) -> CombinedScore:
-        logger = logging.getLogger(__name__)
-        t = time()
-        nrmse = RMSEScore.create(template, test)
-        logger.debug(f"MSE score took {time() - t}")
-        t = time()
-        ssim = SSimScore.create(template, test)
-        logger.debug(f"SSIM score took {time() - t}")
-        t = time()
-        latxcorr = LateralXCorrScore.create(template, test)
-        logger.debug(f"LatXCORR score took {time() - t}")
-        t = time()
-        axxcorr = AxialXCorrScore.create(template, test)
-        logger.debug(f"AxXCORR score took {time() - t}")
-        t = time()
-        r = ReflectanceScorer.create(template, test)
-        logger.debug(f"Reflectance score took {time() - t}")
-        scores = dict(
-            nrmse=nrmse,
-            ssim=ssim,
-            latxcorr=latxcorr,
-            axxcorr=axxcorr,
-            reflectance=r
-        )
+    """
+    Combines the results of each of the other scorers. Callers that only need some of the sub-scores can select them by
+    name with the `scorers` argument, the unselected scorers are skipped entirely and their fields are left as `None`.
+    """
+    nrmse: typing.Optional[RMSEScore] = None
+    latxcorr: typing.Optional[LateralXCorrScore] = None
+    ssim: typing.Optional[SSimScore] = None
+    axxcorr: typing.Optional[AxialXCorrScore] = None
+    reflectance: typing.Optional[ReflectanceScorer] = None
+
+    @classmethod
+    def create(cls, template: np.ndarray, test: np.ndarray, scorers: typing.Sequence[str] = None) -> CombinedScore:
+        """
+        Args:
+            template: A 3d array of reflectance data that the test array will be compared against
+            test: A 3d array to compare against the template array.
+            scorers: The names of the sub-scores to calculate. If `None` then all of them are calculated.
+        """
+        return cls.createFromPrepared(cls.prepareTemplate(template, scorers), test)
+
+    @classmethod
+    def createBatch(cls, template: np.ndarray, tests: typing.Iterable[np.ndarray], scorers: typing.Sequence[str] = None) -> typing.List[CombinedScore]:
+        prepared = cls.prepareTemplate(template, scorers)
+        return [cls.createFromPrepared(prepared, test) for test in tests]
+
+    @classmethod
+    def prepareTemplate(cls, template: np.ndarray, scorers: typing.Sequence[str] = None) -> _CombinedPreparedTemplate:
+        """Prepare the template for each of the selected sub-scorers. Only the sub-scores selected here will be
+        calculated when scoring with the prepared template.
+
+        Args:
+            template: A 3d array of reflectance data that test arrays will be compared against.
+            scorers: The names of the sub-scores to calculate. If `None` then all of them are calculated.
+        """
+        return _CombinedPreparedTemplate(template, {name: scorer.prepareTemplate(template) for name, scorer in cls.getScorerTypes(scorers).items()})
+
+    @classmethod
+    def estimateMemory(cls, shape: typing.Tuple[int, ...], dtype: np.dtype, scorers: typing.Sequence[str] = None) -> typing.Tuple[int, int]:
+        """The sub-scorers are run one after another so their working memory doesn't add up but their prepared templates do."""
+        estimates = [scorerType.estimateMemory(shape, dtype) for scorerType in cls.getScorerTypes(scorers).values()]
+        return sum(prepared for prepared, _ in estimates), max((working for _, working in estimates), default=0)
+
+    @staticmethod
+    def getScorerTypes(names: typing.Sequence[str] = None) -> typing.Dict[str, typing.Type[Score]]:
+        """Get the `Score` classes used for each sub-score keyed by the name of the field they are stored in.
+
+        Args:
+            names: If provided then only these sub-scores will be included.
+        """
+        scorerTypes = {'nrmse': RMSEScore, 'ssim': SSimScore, 'latxcorr': LateralXCorrScore, 'axxcorr': AxialXCorrScore, 'reflectance': ReflectanceScorer}
+        if names is None:
+            return scorerTypes
+        if len(names) == 0:
+            raise ValueError(f"At least one scorer must be selected. Options are {tuple(scorerTypes)}.")
+        unknown = set(names) - set(scorerTypes)
+        if len(unknown) > 0:
+            raise ValueError(f"Scorers {unknown} are not supported. Options are {tuple(scorerTypes)}.")
+        return {name: scorerType for name, scorerType in scorerTypes.items() if name in names}
+
+    @classmethod
+    def defaultScoreName(cls, scorers: typing.Sequence[str] = None) -> str:
+        """The name to save scores under when none is given. Scores of a subset of the sub-scorers get a name of their
+        own, e.g. "score_nrmse_ssim", so that they never overwrite a full score that was saved as "score".
+
+        Args:
+            scorers: The names of the selected sub-scores. If `None` then all of them are selected.
+        """
+        names = tuple(cls.getScorerTypes(scorers))
+        if names == tuple(cls.getScorerTypes()):
+            return 'score'
+        return '_'.join(('score',) + names)
+
+    @classmethod
+    def createFromPrepared(cls, template: _CombinedPreparedTemplate, test: np.ndarray) -> CombinedScore:
+        subTemplates = template.subTemplates
+        scores = {}
+        if 'nrmse' in subTemplates or 'reflectance' in subTemplates:
+            with instrumentation.span('score.cubeStatistics'):
+                stats = CubePairStatistics.compute(template.data, test)  # Shared by the scorers that only need simple sums.
+            if 'nrmse' in subTemplates:
+                scores['nrmse'] = RMSEScore.fromStatistics(stats)
+            if 'reflectance' in subTemplates:
+                scores['reflectance'] = ReflectanceScorer.fromStatistics(stats)
+        for name, scorerType in cls.getScorerTypes(('ssim', 'latxcorr', 'axxcorr')).items():
+            if name in subTemplates:
+                with instrumentation.span(f'score.{name}'):
+                    scores[name] = scorerType.createFromPrepared(subTemplates[name], test)
+        return cls.fromSubScores(scores)
+
+    @classmethod
+    def createTiled(cls, template: _CombinedPreparedTemplate, test: np.ndarray, tileShape: typing.Tuple[int, int], numThreads: int = None) -> np.ndarray:
+        """Each of the selected sub-scores is calculated for all the tiles at once."""
+        subTemplates = template.subTemplates
+        tiles = {}
+        if 'nrmse' in subTemplates or 'reflectance' in subTemplates:
+            with instrumentation.span('scoreTiled.cubeStatistics'):
+                stats = CubePairStatistics.computeTiled(template.data, test, tileShape, numThreads)
+            for name, scorerType in cls.getScorerTypes(('nrmse', 'reflectance')).items():
+                if name in subTemplates:
+                    tiles[name] = np.empty(stats.shape, dtype=object)
+                    for idx in np.ndindex(stats.shape):
+                        tiles[name][idx] = scorerType.fromStatistics(stats[idx])
+        for name, scorerType in cls.getScorerTypes(('ssim', 'latxcorr', 'axxcorr')).items():
+            if name in subTemplates:
+                with instrumentation.span(f'scoreTiled.{name}'):
+                    tiles[name] = scorerType.createTiled(subTemplates[name], test, tileShape, numThreads)
+        gridShape = tuple(n // t for n, t in zip(test.shape[:2], tileShape))
+        out = np.empty(gridShape, dtype=object)
+        for idx in np.ndindex(gridShape):
+            out[idx] = cls.fromSubScores({name: scores[idx] for name, scores in tiles.items()})
+        return out
+
+    @classmethod
+    def fromSubScores(cls, scores: typing.Dict[str, Score]) -> CombinedScore:
+        """Combine sub-scores that have already been calculated.
+
+        Args:
+            scores: Sub-scores keyed by the name of the field they belong in.
+        """
+        if len(scores) == 0:
+            raise ValueError("At least one sub-score is needed to form a `CombinedScore`.")
         # TODO not sure how to mix the scores. Just taking the average right now.
         score = 0
         for k, v in scores.items():
@@ -245,21 +814,39 @@ class CombinedScore(Score):
 
 @dataclasses.dataclass
 class SplitScore(Score):
+    """
+    The `CombinedScore` of each tile of a lateral grid. `score` is an array of shape (rows, columns, 11) with the values:
+    score, nrmse, ssim, latxcorr, latxcorr cdrX, latxcorr cdrY, latxcorr shift Y, latxcorr shift X, axxcorr, axxcorr cdr, axxcorr shift.
+    """
     score: np.ndarray
 
     @classmethod
-    def create(cls, template: np.ndarray, test: np.ndarray) -> SplitScore:
-        splitter = DualCubeSplitter(template, test)
+    def create(cls, template: np.ndarray, test: np.ndarray, factor: int = 2, numThreads: int = None) -> SplitScore:
+        """
+        Args:
+            template: A 3d array of reflectance data that the test array will be compared against
+            test: A 3d array to compare against the template array.
+            factor: The exponent of 2 that each lateral axis is split by. See `CubeSplitter.subdivide`.
+            numThreads: The number of threads to use. If `None` then `defaultNumThreads()` is used.
+        """
+        return cls.createFromPrepared(cls.prepareTemplate(template), test, factor, numThreads)
 
-        def func(arr1, arr2):
-            score = CombinedScore.create(arr1, arr2)
-            return np.array([score.score, score.nrmse.score, score.ssim.score,
-                             score.latxcorr.score, score.latxcorr.cdrX,
-                             score.latxcorr.cdrY, score.latxcorr.shift[0],
-                             score.latxcorr.shift[1], score.axxcorr.score,
-                             score.axxcorr.cdr, score.axxcorr.shift])
+    @classmethod
+    def prepareTemplate(cls, template: np.ndarray) -> _CombinedPreparedTemplate:
+        return CombinedScore.prepareTemplate(template)
 
-        out = splitter.apply(func, 2)
+    @classmethod
+    def createFromPrepared(cls, template: _CombinedPreparedTemplate, test: np.ndarray, factor: int = 2, numThreads: int = None) -> SplitScore:
+        tileShape = (test.shape[0] // 2**factor, test.shape[1] // 2**factor)
+        scores = CombinedScore.createTiled(template, test, tileShape, numThreads)
+        out = np.zeros(scores.shape + (11,))
+        for idx in np.ndindex(scores.shape):
+            score = scores[idx]
+            out[idx] = [score.score, score.nrmse.score, score.ssim.score,
+                        score.latxcorr.score, score.latxcorr.cdrX,
+                        score.latxcorr.cdrY, score.latxcorr.shift[0],
+                        score.latxcorr.shift[1], score.axxcorr.score,
+                        score.axxcorr.cdr, score.axxcorr.shift]
         return cls(score=out)
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+from __future__ import annotations
+import dataclasses
+import typing
+from multiprocessing import shared_memory
+import numpy as np
+
+_attached: typing.Dict[str, shared_memory.SharedMemory] = {}  # The shared memory blocks that this process has attached to, keyed by block name. Holding a reference keeps the block mapped.
+_unclosed: typing.List[shared_memory.SharedMemory] = []  # Blocks that couldn't be closed yet because views of them were still alive.
+
+
+def _view(shm: shared_memory.SharedMemory, shape: typing.Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    # `frombuffer` holds a buffer export on the block so closing it while the view is alive fails rather than leaving the view dangling.
+    return np.frombuffer(shm.buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _close(shm: shared_memory.SharedMemory):
+    """Close a block. If views of it are still alive, for example held by a traceback, then it is retried on later calls."""
+    _unclosed.append(shm)
+    for block in list(_unclosed):
+        try:
+            block.close()
+            _unclosed.remove(block)
+        except BufferError:
+            pass
+
+
+@dataclasses.dataclass(frozen=True)
+class SharedArrayHandle:
+    """
+    A small, picklable, reference to an array that is stored in shared memory. Sending this to another process is
+    nearly free, the process then calls `attach` to get a zero-copy view of the array.
+
+    Attributes:
+        name: The name of the shared memory block.
+        shape: The shape of the array.
+        dtype: The numpy dtype string of the array.
+        info: Any extra picklable information that is sent along with the array.
+    """
+    name: str
+    shape: typing.Tuple[int, ...]
+    dtype: str
+    info: typing.Any = None
+
+    def attach(self) -> np.ndarray:
+        """Get a view of the shared array. The block stays mapped in this process until `detach` is called."""
+        if self.name not in _attached:
+            _attached[self.name] = shared_memory.SharedMemory(name=self.name)
+        return _view(_attached[self.name], self.shape, self.dtype)
+
+    def detach(self):
+        """Unmap the block from this process. All views returned by `attach` must have been deleted already."""
+        if self.name in _attached:
+            _close(_attached.pop(self.name))
+
+
+@dataclasses.dataclass
+class _Entry:
+    shm: shared_memory.SharedMemory
+    handle: SharedArrayHandle
+    array: np.ndarray
+    refCount: int
+
+
+class SharedArrayRegistry:
+    """
+    Keeps track of named arrays that are stored in `multiprocessing.shared_memory` so they can be handed to worker
+    processes without being pickled. Arrays of any dtype are supported. Each array has a reference count that starts at
+    1 when it is created, the shared memory is freed once the count drops to 0 or when the registry is closed. The
+    registry should only be used from the process that created it, other processes use the `SharedArrayHandle`.
+
+    Can be used as a context manager that closes the registry on exit.
+    """
+    def __init__(self):
+        self._entries: typing.Dict[typing.Hashable, _Entry] = {}
+
+    def allocate(self, key: typing.Hashable, shape: typing.Tuple[int, ...], dtype: np.dtype, info: typing.Any = None) -> np.ndarray:
+        """
+        Create a new, uninitialized, shared array.
+
+        Args:
+            key: The name to store the array under.
+            shape: The shape of the array.
+            dtype: The data type of the array.
+            info: Extra picklable information to store in the `SharedArrayHandle` of the array.
+
+        Returns:
+            A view of the shared array that can be filled in by the caller.
+        """
+        if key in self._entries:
+            raise KeyError(f"A shared array named {key} already exists.")
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        handle = SharedArrayHandle(shm.name, shape, dtype.str, info)
+        array = _view(shm, shape, dtype)
+        self._entries[key] = _Entry(shm, handle, array, 1)
+        return array
+
+    def create(self, key: typing.Hashable, array: np.ndarray, info: typing.Any = None) -> SharedArrayHandle:
+        """Copy `array` into a new shared array. See `allocate`."""
+        np.copyto(self.allocate(key, array.shape, array.dtype, info), array)
+        return self._entries[key].handle
+
+    def handle(self, key: typing.Hashable) -> SharedArrayHandle:
+        return self._entries[key].handle
+
+    def array(self, key: typing.Hashable) -> np.ndarray:
+        """A view of the shared array for use in this process."""
+        return self._entries[key].array
+
+    def acquire(self, key: typing.Hashable) -> SharedArrayHandle:
+        """Increment the reference count of an array. Each call should be matched by a call to `release`."""
+        self._entries[key].refCount += 1
+        return self._entries[key].handle
+
+    def release(self, key: typing.Hashable):
+        """Decrement the reference count of an array, freeing it if nothing else references it."""
+        entry = self._entries[key]
+        entry.refCount -= 1
+        if entry.refCount <= 0:
+            self._free(key)
+
+    def _free(self, key: typing.Hashable):
+        entry = self._entries.pop(key)
+        entry.array = None
+        entry.shm.unlink()  # The memory is freed once every process has closed the block.
+        _close(entry.shm)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._entries
+
+    def keys(self) -> typing.Tuple[typing.Hashable, ...]:
+        return tuple(self._entries.keys())
+
+    def close(self):
+        """Free all of the arrays regardless of their reference count."""
+        for key in self.keys():
+            self._free(key)
+
+    def __enter__(self) -> SharedArrayRegistry:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,9 +1,184 @@
+from __future__ import annotations
+import dataclasses
+import enum
+import os
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 from skimage.transform import AffineTransform
 
+_defaultNumThreads: typing.Optional[int] = None
+
+
+def defaultNumThreads() -> int:
+    """The number of threads used by functions of this package that are given `numThreads=None`. The number of CPUs
+    unless it was changed by `setDefaultNumThreads`."""
+    return _defaultNumThreads or os.cpu_count() or 1
+
+
+def setDefaultNumThreads(numThreads: typing.Optional[int]):
+    """Limit the number of threads used in the current process by this package and by OpenCV. Worker processes that
+    already run one per CPU set this to 1 so that the CPUs aren't oversubscribed. `None` restores the defaults."""
+    global _defaultNumThreads
+    _defaultNumThreads = numThreads
+    cv2.setNumThreads(-1 if numThreads is None else numThreads)  # A negative number resets OpenCV to its default.
+
+
+def applyToSlabs(func: typing.Callable[[slice], typing.Any], length: int, numThreads: int = None) -> typing.List[typing.Any]:
+    """
+    Divide `range(length)` into contiguous slices and call `func` on each of them from a pool of threads. This only
+    helps for functions that spend most of their time in code that releases the GIL, such as `scipy.ndimage` filters.
+
+    Args:
+        func: A function that takes a `slice` as its only argument. Each call is passed a different, non-overlapping slice.
+        length: The length of the axis to divide up.
+        numThreads: The number of threads to use. If `None` then `defaultNumThreads()` is used.
+
+    Returns:
+        A list of the return values of `func` in the order of the slices.
+    """
+    numThreads = max(1, min(length, numThreads or defaultNumThreads()))
+    bounds = np.linspace(0, length, numThreads + 1).astype(int)
+    slices = [slice(int(bounds[i]), int(bounds[i + 1])) for i in range(numThreads)]
+    if numThreads == 1:
+        return [func(slices[0])]
+    with ThreadPoolExecutor(numThreads) as pool:
+        return list(pool.map(func, slices))
+
+
+@dataclasses.dataclass
+class CubePairStatistics:
+    """
+    Sums over every element of a pair of equally shaped arrays. These are enough to calculate several scores (e.g.
+    normalized RMSE and mean reflectance ratio) as well as the means and standard deviations of both arrays.
+    Use `compute` to fill them in with a single pass over memory.
+    """
+    count: int
+    templateSum: float
+    testSum: float
+    templateSquaredSum: float
+    testSquaredSum: float
+    crossSum: float  # The sum of `template * test`
+    squaredDifferenceSum: float  # The sum of `(template - test)**2`
+    ratioSum: float  # The sum of `test / template`
+
+    blockBytes = 2**20  # The size of the blocks that the arrays are processed in. Should be small enough that each block and its temporaries stay in the CPU cache.
+
+    @classmethod
+    def compute(cls, template: np.ndarray, test: np.ndarray) -> CubePairStatistics:
+        """
+        Calculate all the sums in a single pass over the two arrays. The arrays are processed in blocks of
+        `blockBytes` so that the temporary arrays of each block are still in the cache when they are used. Sums are
+        accumulated in float64.
+
+        Args:
+            template: A 2d or 3d array.
+            test: An array with the same shape as `template`.
+        """
+        assert template.shape == test.shape, "Both arrays must have the same shape."
+        sums = np.zeros(7)
+        for blk in cls._iterBlocks(template.shape, np.result_type(template, test).itemsize):
+            sums += cls._blockSums(template[blk], test[blk])
+        return cls(template.size, *(float(i) for i in sums))
+
+    @classmethod
+    def computeTiled(cls, template: np.ndarray, test: np.ndarray, tileShape: typing.Tuple[int, int], numThreads: int = None) -> np.ndarray:
+        """
+        Calculate the statistics of each tile of a lateral grid in a single pass over the two arrays. Each block of
+        rows is reshaped so that the sums of every tile it overlaps are reduced at once. Remainder pixels along the
+        bottom and right edges that don't fill a whole tile are left out.
+
+        Args:
+            template: A 2d or 3d array.
+            test: An array with the same shape as `template`.
+            tileShape: The number of (rows, columns) in each tile.
+            numThreads: The number of threads that the rows of tiles are split between. If `None` then `defaultNumThreads()` is used.
+
+        Returns:
+            A 2d object array with the statistics of each tile.
+        """
+        assert template.shape == test.shape, "Both arrays must have the same shape."
+        gridShape = tuple(n // t for n, t in zip(template.shape[:2], tileShape))
+        width = gridShape[1] * tileShape[1]
+        rowBytes = np.result_type(template, test).itemsize * width * int(np.prod(template.shape[2:]))
+        rowsPerBlock = max(1, cls.blockBytes // rowBytes)
+        sums = np.zeros(gridShape + (7,))
+
+        def sumRows(tileRows: slice):
+            for i in range(tileRows.start, tileRows.stop):
+                for start in range(i * tileShape[0], (i + 1) * tileShape[0], rowsPerBlock):
+                    stop = min(start + rowsPerBlock, (i + 1) * tileShape[0])
+                    tileView = (stop - start, gridShape[1], tileShape[1], -1)  # Splits the columns into tiles.
+                    blockSums = cls._blockSums(template[start:stop, :width].reshape(tileView), test[start:stop, :width].reshape(tileView), axis=(0, 2, 3))
+                    sums[i] += np.stack(blockSums, axis=-1)
+
+        applyToSlabs(sumRows, gridShape[0], numThreads)
+        tileSize = tileShape[0] * tileShape[1] * int(np.prod(template.shape[2:]))
+        out = np.empty(gridShape, dtype=object)
+        for idx in np.ndindex(gridShape):
+            out[idx] = cls(tileSize, *(float(i) for i in sums[idx]))
+        return out
+
+    @staticmethod
+    def _blockSums(t: np.ndarray, x: np.ndarray, axis: typing.Tuple[int, ...] = None) -> typing.List[np.ndarray]:
+        """The sums of a block of the template and test arrays in the order of the fields after `count`."""
+        diff = t - x
+        return [np.sum(t, axis=axis, dtype=np.float64), np.sum(x, axis=axis, dtype=np.float64), np.sum(t * t, axis=axis, dtype=np.float64),
+                np.sum(x * x, axis=axis, dtype=np.float64), np.sum(t * x, axis=axis, dtype=np.float64), np.sum(diff * diff, axis=axis, dtype=np.float64),
+                np.sum(x / t, axis=axis, dtype=np.float64)]
+
+    @classmethod
+    def _iterBlocks(cls, shape: typing.Tuple[int, ...], itemSize: int) -> typing.Iterator[typing.Tuple[slice, ...]]:
+        """Generate slices that divide an array of `shape` into blocks of about `blockBytes`. Blocks are groups of whole
+        rows unless a single row is larger than `blockBytes`, in which case rows are split along the second axis."""
+        pixelBytes = itemSize * int(np.prod(shape[2:]))
+        pixelsPerBlock = max(1, cls.blockBytes // pixelBytes)
+        if pixelsPerBlock >= shape[1]:
+            rowsPerBlock = pixelsPerBlock // shape[1]
+            for row in range(0, shape[0], rowsPerBlock):
+                yield slice(row, row + rowsPerBlock),
+        else:
+            for row in range(shape[0]):
+                for col in range(0, shape[1], pixelsPerBlock):
+                    yield slice(row, row + 1), slice(col, col + pixelsPerBlock)
+
+    # The properties below also work element-wise when the sums are arrays, see `IntegralStatistics`.
+    @property
+    def templateMean(self) -> float:
+        return self.templateSum / self.count
+
+    @property
+    def testMean(self) -> float:
+        return self.testSum / self.count
+
+    @property
+    def templateVariance(self) -> float:
+        return np.maximum(0., self.templateSquaredSum / self.count - self.templateMean ** 2)
+
+    @property
+    def testVariance(self) -> float:
+        return np.maximum(0., self.testSquaredSum / self.count - self.testMean ** 2)
+
+    @property
+    def templateStd(self) -> float:
+        return np.sqrt(self.templateVariance)
+
+    @property
+    def testStd(self) -> float:
+        return np.sqrt(self.testVariance)
+
+    @property
+    def normalizedRMSE(self) -> float:
+        """Equivalent to `skimage.metrics.normalized_root_mse` with `normalization='euclidean'`"""
+        return np.sqrt(self.squaredDifferenceSum / self.templateSquaredSum)
+
+    @property
+    def meanRatio(self) -> float:
+        """The mean of `test / template`"""
+        return self.ratioSum / self.count
+
 
 class CubeSplitter:
     """
@@ -11,41 +186,64 @@ class CubeSplitter:
 
     Args:
         arr: The original array we want to work with, May be 2 or 3 dimensional.
+        remainder: Determines which pixels are left out when the sides of the array can't be divided equally.
     """
-    def __init__(self, arr: np.ndarray):
+    class Remainder(enum.Enum):
+        CROP = "The remainder pixels are left out of the bottom and right edges of the array."
+        CENTER = "The remainder pixels are split between both edges of each axis so that the tiles are centered in the array."
+
+    def __init__(self, arr: np.ndarray, remainder: CubeSplitter.Remainder = Remainder.CROP):
         assert len(arr.shape) in (2, 3), "Only 2 or 3 dimensional arrays are supported."
         self._arr = arr
+        self._remainder = remainder
 
     def subdivide(self, factor: int) -> np.ndarray:
-        """Subdivide the array into a 2d numpy array of sub arrays.
+        """Subdivide the array into a 2d grid of sub arrays.
 
         Args:
             factor: The exponent of 2 that each of the first 2 dimentions of this array should be split by.
             E.G. if `factor` is 3 then the array will be divided into 8 parts on the first to axes resulting in 64 subarrays.
+
+        Returns:
+            A view of the original array with shape (2**factor, 2**factor, *tileShape). Element [i, j] is the subarray
+            in row `i` and column `j` of the grid. No data is copied.
         """
         return self._subdivide(2**factor)
 
     def _subdivide(self, factor: int) -> np.ndarray:
         """
-        Split the array into a 2d numpy array of sub arrays. The remainder pixels that can't be divided up equally are left out.
+        Split the array into a 2d grid of sub arrays. The remainder pixels that can't be divided up equally are left out
+        according to the `remainder` policy.
 
         Args:
             factor: The number to split each axis of the array by. For example, if `factor` is 2 then the array will be split into 4 arrays with sides that are half as long as the original.
 
         Returns:
-            A 2D numpy array where each element contains a subdivided array from the original array.
+            A view of the original array with two leading axes for the rows and columns of the grid.
         """
         shp = self._arr.shape
-        divSize = (shp[0] // factor, shp[1] // factor)
-        lst = []
-        for i in range(factor):
-            subLst = []
-            for j in range(factor):
-                slc = (slice(divSize[0]*i, divSize[0]*(i+1)), slice(divSize[1]*j, divSize[1]*(j+1)))
-                subArr = self._arr[slc]
-                subLst.append(subArr)
-            lst.append(subLst)
-        return np.array(lst)
+        start, divSize = self.tileGrid(shp, factor, self._remainder)
+        arr = self._arr[start[0]:start[0] + factor * divSize[0], start[1]:start[1] + factor * divSize[1]]
+        # Splitting each lateral axis into (tile, pixel) axes only changes the strides so reshaping gives a view.
+        arr = arr.reshape((factor, divSize[0], factor, divSize[1]) + shp[2:]).swapaxes(1, 2)
+        return arr
+
+    @staticmethod
+    def tileGrid(shape: typing.Tuple[int, ...], numSplits: int, remainder: CubeSplitter.Remainder) -> typing.Tuple[typing.Tuple[int, int], typing.Tuple[int, int]]:
+        """
+        Find the layout of the grid of tiles when an array is split into `numSplits` parts along each lateral axis.
+
+        Returns:
+            A tuple of the (row, column) index of the first pixel of the first tile and the (rows, columns) size of each tile.
+        """
+        divSize = (shape[0] // numSplits, shape[1] // numSplits)
+        if remainder == CubeSplitter.Remainder.CROP:
+            start = (0, 0)
+        elif remainder == CubeSplitter.Remainder.CENTER:
+            start = tuple((n - numSplits * d) // 2 for n, d in zip(shape[:2], divSize))
+        else:
+            raise ValueError(f"CubeSplitter remainder policy {remainder} is not supported.")
+        return start, divSize
 
     def apply(self, func: typing.Callable, factor: int) -> np.ndarray:
         """
@@ -58,7 +256,7 @@ class CubeSplitter:
             A 2d numpy array where the value of each element is the result of `func` for the corresponding subarray.
         """
         medArr = self.subdivide(factor)
-        outArr = np.zeros_like(medArr).astype(np.float)
+        outArr = np.zeros(medArr.shape[:2])
         for i in range(outArr.shape[0]):
             for j in range(outArr.shape[1]):
                 outArr[i, j] = func(medArr[i, j])
@@ -66,12 +264,12 @@ class CubeSplitter:
 
 
 class DualCubeSplitter:
-    def __init__(self, arr1: np.ndarray, arr2: np.ndarray):
+    def __init__(self, arr1: np.ndarray, arr2: np.ndarray, remainder: CubeSplitter.Remainder = CubeSplitter.Remainder.CROP):
         assert arr1.shape == arr2.shape, "Both arrays must have the same shape."
-        self._c1 = CubeSplitter(arr1)
-        self._c2 = CubeSplitter(arr2)
+        self._c1 = CubeSplitter(arr1, remainder)
+        self._c2 = CubeSplitter(arr2, remainder)
 
-    def subdivide(self, factor: int):
+    def subdivide(self, factor: int) -> typing.Tuple[np.ndarray, np.ndarray]:
         return self._c1.subdivide(factor), self._c2.subdivide(factor)
 
     def apply(self, func, factor: int):
@@ -92,6 +290,126 @@ class DualCubeSplitter:
         return outArr
 
 
+class IntegralStatistics:
+    """
+    Summed-area tables (integral images) of the moments used by `CubePairStatistics` after summing them over
+    wavelength. Once the tables are built, the sums of any lateral rectangle only take four lookups, so the statistics
+    of every tile at every `CubeSplitter` factor cost about as much as a single pass over the arrays. The tables take
+    56 bytes per XY pixel.
+
+    Args:
+        template: A 2d or 3d array.
+        test: An array with the same shape as `template`.
+    """
+    def __init__(self, template: np.ndarray, test: np.ndarray):
+        assert template.shape == test.shape, "Both arrays must have the same shape."
+        self._shape = template.shape
+        self._table = np.zeros((template.shape[0] + 1, template.shape[1] + 1, 7))
+        wavelengthAxes = tuple(range(2, template.ndim))
+        for blk in CubePairStatistics._iterBlocks(template.shape, np.result_type(template, test).itemsize):
+            # The tables are offset by one pixel so that the first row and column are 0.
+            dst = tuple(slice(slc.start + 1, slc.stop + 1) for slc in blk) + (slice(1, None),) * (2 - len(blk))
+            self._table[dst] = np.stack(CubePairStatistics._blockSums(template[blk], test[blk], axis=wavelengthAxes), axis=-1)
+        np.cumsum(self._table, axis=0, out=self._table)
+        np.cumsum(self._table, axis=1, out=self._table)
+
+    def statistics(self, factor: int, remainder: CubeSplitter.Remainder = CubeSplitter.Remainder.CROP) -> CubePairStatistics:
+        """
+        Get the statistics of each tile of the same grid that `CubeSplitter.subdivide` uses.
+
+        Args:
+            factor: The exponent of 2 that each lateral axis is split by.
+            remainder: Determines which pixels are left out when the sides of the array can't be divided equally.
+
+        Returns:
+            Statistics where each of the sums is a 2d array with an element for each tile.
+        """
+        numSplits = 2**factor
+        start, divSize = CubeSplitter.tileGrid(self._shape, numSplits, remainder)
+        rows = start[0] + np.arange(numSplits + 1) * divSize[0]
+        cols = start[1] + np.arange(numSplits + 1) * divSize[1]
+        corners = self._table[rows[:, None], cols[None, :]]
+        sums = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        count = divSize[0] * divSize[1] * int(np.prod(self._shape[2:]))
+        return CubePairStatistics(count, *np.moveaxis(sums, -1, 0))
+
+    def maps(self, maxFactor: int, remainder: CubeSplitter.Remainder = CubeSplitter.Remainder.CROP) -> typing.List[typing.Dict[str, np.ndarray]]:
+        """
+        Generate maps of the additive metrics for every factor from 0 to `maxFactor`.
+
+        Args:
+            maxFactor: The largest exponent of 2 to split each lateral axis by.
+            remainder: Determines which pixels are left out when the sides of the array can't be divided equally.
+
+        Returns:
+            A list indexed by factor. Each element is a dictionary of 2d maps with an element for each tile. The maps
+            are "nrmse" and "reflectance" which match the `score` of `RMSEScore` and `ReflectanceScorer`,
+            "reflectanceRatio", and the mean and standard deviation of each array.
+        """
+        out = []
+        for factor in range(maxFactor + 1):
+            stats = self.statistics(factor, remainder)
+            out.append({'nrmse': 1 - stats.normalizedRMSE, 'reflectance': 1 - np.abs(1 - stats.meanRatio),
+                        'reflectanceRatio': stats.meanRatio, 'templateMean': stats.templateMean,
+                        'testMean': stats.testMean, 'templateStd': stats.templateStd, 'testStd': stats.testStd})
+        return out
+
+
+class AffineRemap:
+    """
+    Warps images with an affine transform the same way as `cv2.warpAffine` with linear interpolation. The map from
+    output pixels to input coordinates is calculated once, as float32 maps, and is then reused for every image. 3d
+    arrays are warped as stacks of multi-channel images and the stacks are split across threads.
+
+    OpenCV only interpolates exactly for float maps and images with 1, 3 or 4 channels. Otherwise, and for the
+    fixed-point maps made by `cv2.convertMaps`, the coordinates are rounded to 1/32 of a pixel which changes the result
+    by up to a few percent of the data range. Stacks are kept to those sizes so the result matches `cv2.warpAffine` on
+    each image to within float32 precision.
+
+    Args:
+        transform: The 2x3 affine matrix that maps input coordinates to output coordinates, as used by `cv2.warpAffine`.
+        dsize: The (width, height) of the output images, as used by `cv2.warpAffine`.
+    """
+    maxChannels = 4  # The number of images warped together as one multi-channel image. Larger stacks are interpolated with rounded coordinates.
+
+    def __init__(self, transform: np.ndarray, dsize: typing.Tuple[int, int]):
+        inverse = cv2.invertAffineTransform(transform)  # Maps output pixels back to the input coordinates.
+        x, y = np.meshgrid(np.arange(dsize[0]), np.arange(dsize[1]))
+        mapX = (inverse[0, 0] * x + inverse[0, 1] * y + inverse[0, 2]).astype(np.float32)
+        mapY = (inverse[1, 0] * x + inverse[1, 1] * y + inverse[1, 2]).astype(np.float32)
+        self._mapX, self._mapY = mapX, mapY
+
+    def apply(self, arr: np.ndarray, dtype: np.dtype = None, numThreads: int = None) -> np.ndarray:
+        """
+        Warp an image or a stack of images.
+
+        Args:
+            arr: A 2d image or a 3d array that will be warped along the first two axes.
+            dtype: The data type of the output. If `None` then the type of `arr` is used.
+            numThreads: The number of threads used to warp a 3d array. If `None` then `defaultNumThreads()` is used.
+
+        Returns:
+            The warped array.
+        """
+        dtype = arr.dtype if dtype is None else dtype
+        if arr.ndim == 2:
+            return cv2.remap(arr.astype(dtype, copy=False), self._mapX, self._mapY, cv2.INTER_LINEAR)
+        out = np.empty(self._mapX.shape[:2] + arr.shape[2:], dtype=dtype)
+
+        def warpSlab(slc: slice):
+            start = slc.start
+            while start < slc.stop:
+                size = min(self.maxChannels, slc.stop - start)
+                size = 1 if size == 2 else size  # Two channel images would be rounded.
+                stack = slice(start, start + size)
+                start += size
+                warped = cv2.remap(np.ascontiguousarray(arr[:, :, stack], dtype=dtype), self._mapX, self._mapY, cv2.INTER_LINEAR)
+                out[:, :, stack] = warped.reshape(out.shape[:2] + (-1,))  # OpenCV drops the channel axis of single channel images.
+
+        applyToSlabs(warpSlab, arr.shape[2], numThreads)
+        return out
+
+
 class CVAffineTransform(AffineTransform):
     """
     Extends "SciKit-Image" `AffineTransform` to work more easily with the 2x3 matrices that OpenCV uses as an affine transform.
@@ -5,81 +5,336 @@ Created on Mon Oct 26 16:44:06 2020
 @author: nick
 """
 from __future__ import annotations
+import collections
+import contextlib
+import concurrent.futures as cf
+import enum
+import functools
+import logging
+import os
 import typing as t_
 import multiprocessing as mp
+import threading
 import cv2
 import pandas as pd
+from scipy import ndimage
 from scipy.ndimage import binary_dilation
 from pws_calibration_suite.comparison.TransformGenerator import TransformGenerator
-from pwspy.utility.fileIO import processParallel
 
-from . import ITOMeasurement
+from . import ITOMeasurement, instrumentation
 from ._scorers import *
-from ._utility import CVAffineTransform
+from ._folderWatcher import FolderWatcher
+from ._scheduler import MemoryAwareScheduler
+from ._sharedMemory import SharedArrayHandle, SharedArrayRegistry
+from ._utility import AffineRemap, CVAffineTransform, applyToSlabs, setDefaultNumThreads
 from .fileTypes import TransformedData
-from .loaders import settings, AbstractMeasurementLoader
+from .loaders import settings, AbstractMeasurementLoader, DateMeasurementLoader
 from pwspy.utility.reflection import Material
+from pwspy.analysis.pws import PWSAnalysisResults
 
 settings.referenceMaterial = Material.Air
 
 
-def _blur3dDataLaterally(data: np.ndarray, sigma: float) -> np.ndarray:
+def _blur3dDataLaterally(data: np.ndarray, sigma: float, dtype: np.dtype = None, out: np.ndarray = None, numThreads: int = None) -> np.ndarray:
     """
-    Blur a 3D array along the first and second dimension.
+    Blur a 3D array along the first and second dimension. The blur is done as two separable 1d passes on slabs of
+    wavelengths which are split across threads.
     Args:
         data: A 3d numpy array
         sigma: The width of the gaussian kernel used for blurring. In units of pixels.
+        dtype: The floating point type of the output. If `None` then the type of `data` is used. Ignored if `out` is provided.
+        out: An array with the same shape as `data` that the result is written to. Can be `data` itself to blur in place.
+        numThreads: The number of threads to use. If `None` then `defaultNumThreads()` is used.
 
     Returns:
         The blurred data.
     """
-    from scipy import ndimage
-    newData = np.zeros_like(data)
-    for i in range(data.shape[2]):
-        newData[:, :, i] = ndimage.filters.gaussian_filter(data[:, :, i], sigma, mode='reflect')
-    return newData
+    if out is None:
+        out = np.empty(data.shape, dtype=data.dtype if dtype is None else dtype)
+    assert out.shape == data.shape, "The output array must have the same shape as the data."
 
+    def blurSlab(slc: slice):
+        ndimage.gaussian_filter1d(data[:, :, slc], sigma, axis=0, output=out[:, :, slc], mode='reflect')
+        ndimage.gaussian_filter1d(out[:, :, slc], sigma, axis=1, output=out[:, :, slc], mode='reflect')
 
-def _score(measurement: ITOMeasurement, scoreName: str, blurSigma: float, templateIdTag: str, templateArr: np.ndarray, lock: mp.Lock = None) -> pd.Series:
+    with instrumentation.span('blur'):
+        applyToSlabs(blurSlab, data.shape[2], numThreads)
+    return out
+
+
+def _loadCachedScores(tData: TransformedData, scorers: t_.Sequence[str], blurSigma: t_.Optional[float], dtype: np.dtype,
+                      useCache: bool) -> t_.Tuple[t_.Dict[str, str], t_.Dict[str, Score]]:
+    """Find the cache keys of the selected sub-scores and load any of them that have already been calculated.
+
+    Returns:
+        A tuple of: The cache keys keyed by sub-score name and the sub-scores that were found in the cache keyed by name.
+    """
+    scorerTypes = CombinedScore.getScorerTypes(scorers)
+    cacheKeys = {name: tData.scoreCacheKey(name, scorerType.version, blurSigma, dtype, scorerType.cacheConfig()) for name, scorerType in scorerTypes.items()}
+    subScores = {}
+    if useCache:
+        for name, scorerType in scorerTypes.items():
+            cached = tData.getCachedScore(cacheKeys[name], scorerType)
+            if cached is not None:
+                subScores[name] = cached
+            instrumentation.count('scoreCache.miss' if cached is None else 'scoreCache.hit')
+    return cacheKeys, subScores
+
+
+def _iterIncrementalBlurs(data: np.ndarray, sigmas: t_.Iterable[t_.Optional[float]], dtype: np.dtype,
+                          inPlace: bool = False) -> t_.Iterator[t_.Tuple[t_.Optional[float], np.ndarray]]:
+    """
+    Blur `data` laterally with each of `sigmas` in ascending order. Each blur is built from the previous one since a
+    gaussian of sigma2 is equal to a gaussian of sqrt(sigma2**2 - sigma1**2) applied to the sigma1 result. Due to the
+    boundary handling the results differ slightly from blurring `data` directly within a few sigma of the array edges.
+
+    Args:
+        data: A 3d numpy array.
+        sigmas: The sigmas to blur by. `None` means no blur.
+        dtype: The floating point type of the output.
+        inPlace: If `True` then each blur overwrites the previously yielded array, only use this when the previous
+            array is no longer needed. `data` is also overwritten if it is already of type `dtype`.
+
+    Yields:
+        A tuple of each sigma and the blurred data.
+    """
+    current, currentSigma = data.astype(dtype, copy=False), 0
+    for sigma in sorted(set(sigmas), key=lambda sig: 0 if sig is None else sig):
+        if sigma is not None and sigma > currentSigma:
+            current = _blur3dDataLaterally(current, np.sqrt(sigma**2 - currentSigma**2), dtype=dtype, out=current if inPlace else None)
+            currentSigma = sigma
+        yield sigma, current
+
+
+def _scoreBlurSweep(measurement: ITOMeasurement, scoreNames: t_.Dict[t_.Optional[float], str], templateIdTag: str,
+                    scorers: t_.Sequence[str], dtype: np.dtype, useCache: bool,
+                    templates: t_.Dict[t_.Optional[float], t_.Optional[PreparedTemplate]],
+                    testData: t_.Optional[t_.Tuple[t_.Tuple[slice, slice], np.ndarray]] = None) -> t_.List[pd.Series]:
+    """Score a single measurement at one or more blur sigmas. The transformed data is only loaded once and the blurs
+    are built incrementally.
+
+    Args:
+        measurement: The measurement to score.
+        scoreNames: The name to save the score under for each blur sigma.
+        templateIdTag: The `idTag` of the template measurement.
+        scorers: The names of the `CombinedScore` sub-scores to calculate.
+        dtype: The floating point precision to blur and score in.
+        useCache: If `True` then previously calculated sub-scores are loaded from the cache.
+        templates: The prepared (and blurred) template for each blur sigma. Only needs to contain the scorers that are
+            missing from the cache.
+        testData: The valid data slice and the valid transformed data of the measurement, in `dtype`, if it is already
+            in memory. It is not modified. If `None` then it is loaded from file.
+    """
+    newScores = _calculateBlurSweep(measurement, scoreNames.keys(), templateIdTag, scorers, dtype, useCache, templates, testData)
+    return _commitBlurSweep(measurement, scoreNames, templateIdTag, scorers, dtype, useCache, newScores)
+
+
+def _calculateBlurSweep(measurement: ITOMeasurement, blurSigmas: t_.Iterable[t_.Optional[float]], templateIdTag: str,
+                        scorers: t_.Sequence[str], dtype: np.dtype, useCache: bool,
+                        templates: t_.Dict[t_.Optional[float], t_.Optional[PreparedTemplate]],
+                        testData: t_.Optional[t_.Tuple[t_.Tuple[slice, slice], np.ndarray]] = None) -> t_.Dict[t_.Optional[float], t_.Dict[str, Score]]:
+    """Calculate the sub-scores of a measurement that are missing from the cache, see `_scoreBlurSweep`. Nothing is
+    written to file so this can safely be run in a worker process.
+
+    Returns:
+        The newly calculated sub-scores for each blur sigma.
+    """
+    logger = logging.getLogger(__name__)
+    with instrumentation.measurement(measurement.name):
+        logger.debug(f"Scoring measurement {measurement.name}")
+        tData = measurement.loadTransformedData(templateIdTag=templateIdTag)
+        missing = {}
+        for blurSigma in blurSigmas:
+            _, cached = _loadCachedScores(tData, scorers, blurSigma, dtype, useCache)
+            missing[blurSigma] = [name for name in scorers if name not in cached]
+        missing = {blurSigma: names for blurSigma, names in missing.items() if len(names) > 0}
+        newScores = {blurSigma: {} for blurSigma in blurSigmas}
+        if len(missing) > 0:
+            if testData is None:
+                slc, testArr = tData.loadValidData(lambda srcSlc: _loadReflectance(measurement, srcSlc, dtype), measurement.name)
+            else:
+                slc, testArr = testData
+            for blurSigma, testArr in _iterIncrementalBlurs(testArr, missing.keys(), dtype, inPlace=testData is None):  # Data that was passed in may be shared, don't modify it.
+                logger.debug(f"Calculating {missing[blurSigma]} for measurement {measurement.name} with blur {blurSigma}")
+                newScore = CombinedScore.createFromPrepared(templates[blurSigma].select(missing[blurSigma])[slc], testArr)
+                newScores[blurSigma] = {name: getattr(newScore, name) for name in missing[blurSigma]}
+        return newScores
+
+
+def _commitBlurSweep(measurement: ITOMeasurement, scoreNames: t_.Dict[t_.Optional[float], str], templateIdTag: str,
+                     scorers: t_.Sequence[str], dtype: np.dtype, useCache: bool,
+                     newScores: t_.Dict[t_.Optional[float], t_.Dict[str, Score]]) -> t_.List[pd.Series]:
+    """Combine the sub-scores from `_calculateBlurSweep` with the cached sub-scores and write them to file. Only one
+    process should ever call this for a given measurement at a time."""
+    out = []
+    with instrumentation.measurement(measurement.name), instrumentation.span('writeScores'):
+        tData = measurement.loadTransformedData(templateIdTag=templateIdTag)
+        for blurSigma, scoreName in scoreNames.items():
+            cacheKeys, subScores = _loadCachedScores(tData, scorers, blurSigma, dtype, useCache)
+            subScores.update(newScores[blurSigma])
+            score = CombinedScore.fromSubScores({name: subScores[name] for name in scorers})
+            for name, subScore in newScores[blurSigma].items():
+                tData.addCachedScore(cacheKeys[name], subScore)
+            tData.addScore(scoreName, score, overwrite=True)
+            out.append(pd.Series({'measurement': measurement, 'blurSigma': blurSigma, 'score': score}))
+    return out
+
+
+def _score(measurement: ITOMeasurement, scoreName: str, blurSigma: float, templateIdTag: str, scorers: t_.Sequence[str],
+           dtype: np.dtype, useCache: bool, template: t_.Optional[PreparedTemplate],
+           testData: t_.Optional[t_.Tuple[t_.Tuple[slice, slice], np.ndarray]] = None) -> pd.Series:
+    out = _scoreBlurSweep(measurement, {blurSigma: scoreName}, templateIdTag, scorers, dtype, useCache, {blurSigma: template}, testData)
+    return out[0].drop('blurSigma')
+
+
+def _findUncachedScorers(loader: AbstractMeasurementLoader, scorers: t_.Sequence[str], blurSigma: t_.Optional[float],
+                         dtype: np.dtype, useCache: bool) -> t_.Tuple[str, ...]:
+    """Find which of the `scorers` are missing from the score cache of at least one of the measurements."""
+    if not useCache:
+        return tuple(scorers)
+    needed = set()
+    for m in loader.measurements:
+        _, cached = _loadCachedScores(m.loadTransformedData(loader.template.idTag), scorers, blurSigma, dtype, useCache)
+        needed.update(set(scorers) - set(cached))
+    return tuple(name for name in scorers if name in needed)
+
+
+def _loadReflectance(measurement: ITOMeasurement, slc: t_.Tuple[slice, slice], dtype: np.dtype) -> np.ndarray:
+    """Load a lateral region of the reflectance of a measurement, including the mean reflectance, in a new array."""
+    with instrumentation.span('load', measurement.name):
+        results = measurement.analysisResults
+        out = np.add(results.reflectance.data[slc], results.meanReflectance[slc][:, :, None], dtype=dtype)
+    instrumentation.count('bytesRead', out.nbytes, measurement.name)
+    return out
+
+
+def _loadTemplateArray(loader: AbstractMeasurementLoader, dtype: np.dtype) -> np.ndarray:
+    return _loadReflectance(loader.template, (slice(None), slice(None)), dtype)
+
+
+def _iterBlurredTemplates(loader: AbstractMeasurementLoader, blurSigmas: t_.Iterable[t_.Optional[float]], dtype: np.dtype,
+                          useCache: bool = True) -> t_.Iterator[t_.Tuple[t_.Optional[float], np.ndarray]]:
+    """Get the template array blurred by each of `blurSigmas`. Blurred templates are memory-mapped from the template's
+    disk cache when available, the rest are blurred from the unblurred template and saved to the cache. Each one is
+    blurred directly rather than incrementally so that a cached array doesn't depend on which other sigmas were
+    requested along with it. The arrays must not be modified."""
     logger = logging.getLogger(__name__)
-    logger.debug(f"Scoring measurement {measurement.name}")
-    tData = measurement.loadTransformedData(templateIdTag=templateIdTag)
-    slc = tData.getValidDataSlice()
-    templateSubArr = templateArr[slc]
-    testArr = tData.transformedData[slc]
-    if blurSigma is not None:
-        testArr = _blur3dDataLaterally(testArr, blurSigma)
-    score = CombinedScore.create(templateSubArr, testArr)
-    if lock is not None:
-        lock.acquire()
+    missing = []
+    for blurSigma in blurSigmas:
+        cached = loader.template.loadTemplateCache(blurSigma, dtype) if useCache else None
+        if cached is None:
+            missing.append(blurSigma)
+        else:
+            logger.debug(f"Loaded cached template for blur {blurSigma}")
+            yield blurSigma, cached
+    if len(missing) > 0:
+        unblurred = _loadTemplateArray(loader, dtype)
+        for blurSigma in missing:
+            templateArr = unblurred if blurSigma is None else _blur3dDataLaterally(unblurred, blurSigma, dtype=dtype)
+            try:
+                templateArr = loader.template.saveTemplateCache(templateArr, blurSigma, dtype)
+            except OSError as e:  # For example if the folder is read-only, we can still go ahead without caching.
+                logger.warning(f"Failed to cache the template for blur {blurSigma}: {e}")
+            yield blurSigma, templateArr
+
+
+def _loadBlurredTemplate(loader: AbstractMeasurementLoader, blurSigma: t_.Optional[float], dtype: np.dtype, useCache: bool = True) -> np.ndarray:
+    return next(_iterBlurredTemplates(loader, (blurSigma,), dtype, useCache))[1]
+
+
+def _estimateJobMemory(shape: t_.Tuple[int, ...], dtype: np.dtype, scorers: t_.Iterable[t_.Sequence[str]]) -> int:
+    """Estimate the peak memory of a worker process that scores measurements with data of `shape` against a template
+    prepared for each of the sequences of sub-score names in `scorers`."""
+    estimates = [CombinedScore.estimateMemory(shape, dtype, names) for names in scorers]
+    prepared, working = sum(p for p, _ in estimates), max((w for _, w in estimates), default=0)
+    cubeBytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return prepared + working + 2 * cubeBytes  # The transformed data is loaded from file and then cropped and converted to `dtype`.
+
+
+def parallelInit(templateSources: t_.Dict[t_.Optional[float], t_.Union[SharedArrayHandle, str]], scorers: t_.Dict[t_.Optional[float], t_.Sequence[str]]):
+    """Each source in `templateSources` is either the handle of a shared array or the path of a `.npy` file to memory-map,
+    keyed by the blur sigma of the template. The templates are prepared for the sub-scores in `scorers` of the same sigma.
+    The scheduler already runs a worker for each CPU so each worker only uses a single thread."""
+    global _templates
+    setDefaultNumThreads(1)
+    _templates = {}
+    for blurSigma, templateSource in templateSources.items():
+        templateArr = np.load(templateSource, mmap_mode='r') if isinstance(templateSource, str) else templateSource.attach()
+        _templates[blurSigma] = CombinedScore.prepareTemplate(templateArr, scorers[blurSigma])  # Each process prepares the templates once and reuses them for all of its measurements.
+
+
+def parallelScoreWrapper(job: t_.Tuple[ITOMeasurement, t_.Optional[SharedArrayHandle]], blurSigmas: t_.Sequence[t_.Optional[float]], templateIdTag: str,
+                         scorers: t_.Sequence[str], dtype: np.dtype, useCache: bool,
+                         instrument: bool = False) -> t_.Tuple[t_.Dict[t_.Optional[float], t_.Dict[str, Score]], t_.List[instrumentation.Record]]:
+    """Returns the new sub-scores and, if `instrument` is `True`, the instrumentation records to merge into the parent's recorder."""
+    measurement, testHandle = job
+    mp.get_logger().warning(f"Scoring measurement {measurement.name}")  # We use warning since the `info` level already has a log of unwanted messages.
+    testData = None if testHandle is None else (testHandle.info, testHandle.attach())
     try:
-        tData.addScore(scoreName, score, overwrite=True)
+        with instrumentation.Recorder() if instrument else contextlib.nullcontext() as recorder:
+            newScores = _calculateBlurSweep(measurement, blurSigmas, templateIdTag, scorers, dtype, useCache, _templates, testData)
+        return newScores, [] if recorder is None else recorder.records
     finally:
-        if lock is not None:
-            lock.release()
-        return pd.Series({'measurement': measurement, 'score': score})
+        if testHandle is not None:
+            del testData
+            testHandle.detach()
 
 
-def parallelInit(lck: mp.Lock, templateArr: np.ndarray):
-    global _lock
-    _lock = lck
-    global _templateArr
-    _templateArr = templateArr
+def _scoreInParallel(loader: AbstractMeasurementLoader, scoreNames: t_.Dict[t_.Optional[float], str],
+                     templateArrs: t_.Dict[t_.Optional[float], np.ndarray], needed: t_.Dict[t_.Optional[float], t_.Sequence[str]],
+                     dtype: np.dtype, scorers: t_.Tuple[str, ...], useCache: bool, maxProcesses: t_.Optional[int],
+                     registry: SharedArrayRegistry) -> t_.List[t_.List[pd.Series]]:
+    """Score each measurement at the blur sigmas of `scoreNames` in a pool of worker processes, see `MemoryAwareScheduler`.
+    Each worker loads a measurement once and builds its blurs incrementally. Scores are committed by this process as
+    they arrive.
 
+    Args:
+        templateArrs: The blurred template for each of the sigmas that has sub-scores missing from the cache. The
+            arrays are removed from the dictionary once they are shared with the workers so that they can be freed.
+        needed: The sub-scores that the template of each sigma in `templateArrs` is prepared for.
+        registry: Aligned data that was placed in this registry is scored directly from shared memory and released once
+            it has been scored. Templates that aren't memory-mapped from the disk cache are shared through it.
 
-def parallelScoreWrapper(row, args):
-    i, row = row
-    mp.get_logger().warning(f"Scoring measurement {row.measurement.name}")  # We use warning since the `info` level already has a log of unwanted messages.
-    _score(row.measurement, *args, templateArr=_templateArr, lock=_lock)
-
+    Returns:
+        The output of `_commitBlurSweep` for each measurement.
+    """
+    def sharedHandle(m: ITOMeasurement) -> t_.Optional[SharedArrayHandle]:
+        if m.name in registry and np.dtype(registry.handle(m.name).dtype) == np.dtype(dtype):
+            return registry.handle(m.name)
+        return None
 
-def createSharedArray(array: np.ndarray) -> np.ndarray:
-    import ctypes
-    assert array.dtype == np.float32
-    sharedArr = mp.RawArray(ctypes.c_float, array.size)
-    npSharedArr = np.frombuffer(sharedArr, dtype=array.dtype).reshape(array.shape)
-    np.copyto(npSharedArr, array)
-    return npSharedArr
+    mplogger = mp.get_logger()
+    mplogger.setLevel(logging.WARNING)
+    templateKeys = []
+    templateSources = {}
+    out = [None] * len(loader.measurements)
+    try:
+        shape = next(iter(templateArrs.values())).shape
+        while len(templateArrs) > 0:
+            blurSigma, templateArr = templateArrs.popitem()
+            if isinstance(templateArr, np.memmap):  # Workers map the cache file themselves.
+                templateSources[blurSigma] = templateArr.filename
+            else:
+                templateKeys.append(('template', loader.template.idTag, blurSigma))
+                templateSources[blurSigma] = registry.create(templateKeys[-1], templateArr)
+            del templateArr
+        jobMemory = _estimateJobMemory(shape, dtype, (needed[blurSigma] for blurSigma in templateSources))
+        scheduler = MemoryAwareScheduler(jobMemory, maxProcesses=maxProcesses, initializer=parallelInit,
+                                         initArgs=(templateSources, {blurSigma: needed[blurSigma] for blurSigma in templateSources}))
+        job = functools.partial(parallelScoreWrapper, blurSigmas=tuple(scoreNames), templateIdTag=loader.template.idTag,
+                                scorers=scorers, dtype=dtype, useCache=useCache, instrument=instrumentation.getRecorder() is not None)
+        for i, (newScores, records) in scheduler.map(job, [(m, sharedHandle(m)) for m in loader.measurements]):
+            instrumentation.merge(records)
+            # Results are committed as they arrive so that only this process ever writes to the files.
+            m = loader.measurements[i]
+            out[i] = _commitBlurSweep(m, scoreNames, loader.template.idTag, scorers, dtype, useCache, newScores)
+            if m.name in registry:
+                registry.release(m.name)
+    finally:
+        for key in templateKeys:
+            if key in registry:
+                registry.release(key)
+    return out
 
 
 class TransformedDataScorer:
@@ -95,28 +350,221 @@ class TransformedDataScorer:
             at the beginning of the scoring process. This blur helps to reduce the effects of random measurement noise
             and slight pixel-scale differences in data alignment. Too much blurring can reduce sensitivity of the scorers.
         parallel: If `True` the measurements will be scored in parallel on multiple cores. Will use much more RAM but
-            will be faster in most situations when many measurements need to be scored.
+            will be faster in most situations when many measurements need to be scored. The number of processes is
+            chosen from the estimated memory use of each process and the available memory, see `MemoryAwareScheduler`.
+            Scores are only ever written to file by the main process.
+        dtype: The floating point precision that the template and test data are blurred and scored in. float32 halves
+            the memory usage compared to float64 and is precise enough for all of the scorers.
+        scorers: The names of the `CombinedScore` sub-scores to calculate. If `None` then all of them are calculated.
+            See `CombinedScore.getScorerTypes` for the available names.
+        useCache: If `True` then sub-scores that were previously calculated from the same transformed data with the
+            same `blurSigma`, `dtype` and scorer `version` are loaded from the file rather than being recalculated. The
+            blurred template is also memory-mapped from the template's disk cache, see `ITOMeasurement.loadTemplateCache`.
+        maxProcesses: The maximum number of processes to use when `parallel` is `True`. If `None` then the number of
+            CPUs is used.
+        registry: Aligned data that was placed in this registry by `TransformedDataSaver` is scored directly from shared
+            memory instead of being loaded from file. Each measurement's entry is released once it has been scored.
      """
 
     def __init__(self, loader: AbstractMeasurementLoader, scoreName: str, blurSigma: t_.Optional[float] = 2,
-                 parallel: bool = False):
-        # Scoring the bulk arrays
-        templateArr: np.ndarray = (loader.template.analysisResults.reflectance + loader.template.analysisResults.meanReflectance[:, :, None]).data
-        if blurSigma is not None:
-            templateArr = _blur3dDataLaterally(templateArr, blurSigma)
-        df = pd.DataFrame({"measurement": loader.measurements})
+                 parallel: bool = False, dtype: np.dtype = np.float32, scorers: t_.Optional[t_.Sequence[str]] = None,
+                 useCache: bool = True, maxProcesses: t_.Optional[int] = None, registry: t_.Optional[SharedArrayRegistry] = None):
+        scorers = tuple(CombinedScore.getScorerTypes(scorers))
+        ownsRegistry = registry is None
+        registry = SharedArrayRegistry() if ownsRegistry else registry
+        try:
+            with instrumentation.run('TransformedDataScorer'):
+                self.output = self._run(loader, scoreName, blurSigma, parallel, dtype, scorers, useCache, maxProcesses, registry)
+        finally:
+            if ownsRegistry:
+                registry.close()
+
+    @staticmethod
+    def _run(loader: AbstractMeasurementLoader, scoreName: str, blurSigma: t_.Optional[float], parallel: bool, dtype: np.dtype,
+             scorers: t_.Tuple[str, ...], useCache: bool, maxProcesses: t_.Optional[int], registry: SharedArrayRegistry) -> pd.DataFrame:
+        def sharedHandle(m: ITOMeasurement) -> t_.Optional[SharedArrayHandle]:
+            if m.name in registry and np.dtype(registry.handle(m.name).dtype) == np.dtype(dtype):
+                return registry.handle(m.name)
+            return None
 
+        def releaseShared(m: ITOMeasurement):
+            if m.name in registry:
+                registry.release(m.name)
+
+        needed = _findUncachedScorers(loader, scorers, blurSigma, dtype, useCache)  # Only these sub-scores need a prepared template.
+        procArgs = (scoreName, blurSigma, loader.template.idTag, scorers, dtype, useCache)
+        if len(needed) == 0:  # Everything is cached, we don't even need to load the template.
+            return pd.DataFrame([_score(m, *procArgs, template=None) for m in loader.measurements])
+
+        # Scoring the bulk arrays
         if parallel:
-            mplogger = mp.get_logger()
-            mplogger.setLevel(logging.WARNING)
-            lock = mp.Lock()
-            sharedArr = createSharedArray(templateArr)
-            out = processParallel(df, parallelScoreWrapper, procArgs=(scoreName, blurSigma, loader.template.idTag),
-                                  initializer=parallelInit, initArgs=(lock, sharedArr), numProcesses=4)
-        else:
-            procArgs = (scoreName, blurSigma, loader.template.idTag, templateArr)
-            out = df.apply(lambda row: _score(row.measurement, *procArgs), axis=1)
-        self.output = pd.DataFrame(out)
+            out = _scoreInParallel(loader, {blurSigma: scoreName}, {blurSigma: _loadBlurredTemplate(loader, blurSigma, dtype, useCache)},
+                                   {blurSigma: needed}, dtype, scorers, useCache, maxProcesses, registry)
+            return pd.DataFrame([scores[0].drop('blurSigma') for scores in out])
+        template = CombinedScore.prepareTemplate(_loadBlurredTemplate(loader, blurSigma, dtype, useCache), needed)
+        out = [None] * len(loader.measurements)
+        for i, m in enumerate(loader.measurements):
+            handle = sharedHandle(m)
+            testData = None if handle is None else (handle.info, registry.array(m.name))
+            out[i] = _score(m, *procArgs, template=template, testData=testData)
+            del testData
+            releaseShared(m)
+        return pd.DataFrame(out)
+
+
+class BlurSweepScorer:
+    """Scores a series of measurements against a template the same way as `TransformedDataScorer` but at several blur
+    sigmas. The sigmas are scored in groups of `maxPreparedTemplates` so that only the prepared templates of one group
+    are held in memory at a time. Within a group each "TransformedData" file is only loaded once and the blurred arrays
+    for each sigma are built incrementally from the previous, smaller, sigma. Each file is therefore loaded once per
+    group rather than once in total, raise `maxPreparedTemplates` to trade memory for fewer loads.
+
+    Args:
+        loader: A data loader object that provides access to a `template` measurement and a sequence of `measurement`
+            measurements.
+        blurSigmas: The sigmas of the gaussian blur to score at. See `TransformedDataScorer` for more information.
+        scoreNameFormat: Formatted with each sigma to give the name that the score for that sigma is saved under.
+        parallel: If `True` the measurements will be scored in parallel on multiple cores, see `TransformedDataScorer`.
+            Each worker process holds the prepared templates of a group and scores the whole group for each measurement
+            that it is given.
+        dtype: The floating point precision that the template and test data are blurred and scored in.
+        scorers: The names of the `CombinedScore` sub-scores to calculate. If `None` then all of them are calculated.
+        useCache: If `True` then sub-scores and blurred templates that were previously calculated with the same inputs are reused.
+        maxProcesses: The maximum number of processes to use when `parallel` is `True`. If `None` then the number of
+            CPUs is used.
+    """
+    maxPreparedTemplates = 2  # The number of sigmas that are scored together. Each one holds a prepared template in memory.
+
+    def __init__(self, loader: AbstractMeasurementLoader, blurSigmas: t_.Sequence[t_.Optional[float]], scoreNameFormat: str = "{}",
+                 parallel: bool = False, dtype: np.dtype = np.float32, scorers: t_.Optional[t_.Sequence[str]] = None,
+                 useCache: bool = True, maxProcesses: t_.Optional[int] = None):
+        scorers = tuple(CombinedScore.getScorerTypes(scorers))
+        scoreNames = {blurSigma: scoreNameFormat.format(blurSigma) for blurSigma in blurSigmas}
+        with instrumentation.run('BlurSweepScorer'), contextlib.closing(SharedArrayRegistry()) as registry:
+            self.output = self._run(loader, scoreNames, parallel, dtype, scorers, useCache, maxProcesses, registry)
+
+    @classmethod
+    def _run(cls, loader: AbstractMeasurementLoader, scoreNames: t_.Dict[t_.Optional[float], str], parallel: bool, dtype: np.dtype,
+             scorers: t_.Tuple[str, ...], useCache: bool, maxProcesses: t_.Optional[int], registry: SharedArrayRegistry) -> pd.DataFrame:
+        logger = logging.getLogger(__name__)
+        sigmas = sorted(scoreNames.keys(), key=lambda sig: 0 if sig is None else sig)
+        groupSize = max(1, cls.maxPreparedTemplates)
+        out = []
+        for i in range(0, len(sigmas), groupSize):
+            groupNames = {blurSigma: scoreNames[blurSigma] for blurSigma in sigmas[i:i + groupSize]}
+            needed = {blurSigma: _findUncachedScorers(loader, scorers, blurSigma, dtype, useCache) for blurSigma in groupNames}
+            neededSigmas = [blurSigma for blurSigma, names in needed.items() if len(names) > 0]
+            if parallel and len(neededSigmas) > 0:
+                templateArrs = dict(_iterBlurredTemplates(loader, neededSigmas, dtype, useCache))
+                for scores in _scoreInParallel(loader, groupNames, templateArrs, needed, dtype, scorers, useCache, maxProcesses, registry):
+                    out += scores
+                continue
+            templates = {blurSigma: None for blurSigma in groupNames}
+            if len(neededSigmas) > 0:
+                for blurSigma, templateArr in _iterBlurredTemplates(loader, neededSigmas, dtype, useCache):
+                    logger.debug(f"Preparing template for blur {blurSigma}")
+                    templates[blurSigma] = CombinedScore.prepareTemplate(templateArr, needed[blurSigma])
+            for m in loader.measurements:
+                out += _scoreBlurSweep(m, groupNames, loader.template.idTag, scorers, dtype, useCache, templates)
+            del templates  # Release this group's templates before the next group is prepared.
+        return pd.DataFrame(out)
+
+
+class _BackgroundWriter:
+    """
+    Runs file writes on a single background thread in the order that they are submitted, so that they overlap with
+    computation in the main thread while there is still only one thread writing to the files. `submit` blocks while
+    `maxPending` writes are already waiting so that the data queued for writing can't fill up the memory.
+
+    Can be used as a context manager that waits for all of the writes to finish on exit.
+    """
+    def __init__(self, maxPending: int = 2):
+        self._executor = cf.ThreadPoolExecutor(max_workers=1, thread_name_prefix="TransformedDataWriter")
+        self._maxPending = maxPending
+        self._pending = collections.deque()
+
+    def submit(self, func: t_.Callable, *args, **kwargs) -> cf.Future:
+        while len(self._pending) >= self._maxPending:
+            self._pending.popleft().result()  # Raises any error from the writes right away.
+        future = self._executor.submit(func, *args, **kwargs)
+        self._pending.append(future)
+        return future
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while len(self._pending) > 0:
+            self._pending.popleft().result()
+
+    def __enter__(self) -> _BackgroundWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _PipelinedScorer:
+    """
+    Scores measurements the same way as `TransformedDataScorer` but takes the aligned data straight from
+    `TransformedDataSaver` as soon as each measurement has been transformed rather than loading it from file. Scores
+    are committed on the background writer's thread, after the file of the data has been written. If provided,
+    `onCommit` is called with each measurement and the future of its commit as soon as the commit is submitted.
+    Commits are tracked by the path of the measurement until they are returned by `getOutput`, so a long running
+    `IncrementalAnalyzer` doesn't accumulate them and measurements with the same name in different folders are kept apart.
+    """
+    def __init__(self, loader: AbstractMeasurementLoader, scoreName: str, blurSigma: t_.Optional[float], dtype: np.dtype,
+                 scorers: t_.Optional[t_.Sequence[str]], useCache: bool, writer: _BackgroundWriter,
+                 onCommit: t_.Optional[t_.Callable[[ITOMeasurement, cf.Future], None]] = None):
+        self._onCommit = onCommit
+        self._loader = loader
+        self._scoreName = scoreName
+        self._blurSigma = blurSigma
+        self._dtype = dtype
+        self._scorers = tuple(CombinedScore.getScorerTypes(scorers))
+        self._useCache = useCache
+        self._writer = writer
+        self._template = None
+        self._commits: t_.Dict[str, cf.Future] = {}  # Keyed by `_key`.
+
+    def _getTemplate(self) -> PreparedTemplate:
+        if self._template is None:  # Prepared on first use since everything may already be cached.
+            templateArr = _loadBlurredTemplate(self._loader, self._blurSigma, self._dtype, self._useCache)
+            self._template = CombinedScore.prepareTemplate(templateArr, self._scorers)
+        return self._template
+
+    @staticmethod
+    def _key(measurement: ITOMeasurement) -> str:
+        return os.path.abspath(measurement.filePath)
+
+    def _commit(self, measurement: ITOMeasurement, newScores: t_.Dict[t_.Optional[float], t_.Dict[str, Score]]):
+        commit = self._writer.submit(_commitBlurSweep, measurement, {self._blurSigma: self._scoreName},
+                                     self._loader.template.idTag, self._scorers, self._dtype, self._useCache, newScores)
+        self._commits[self._key(measurement)] = commit
+        if self._onCommit is not None:
+            self._onCommit(measurement, commit)
+
+    def scoreTransformed(self, measurement: ITOMeasurement, slc: t_.Tuple[slice, slice], data: np.ndarray):
+        """Score freshly aligned data. Its file is being (re)written so there is nothing cached for it yet. `data` may
+        still be in the process of being written so it is not modified."""
+        logging.getLogger(__name__).debug(f"Scoring measurement {measurement.name} from memory")
+        if self._blurSigma is not None:
+            data = _blur3dDataLaterally(data, self._blurSigma, dtype=self._dtype)
+        score = CombinedScore.createFromPrepared(self._getTemplate()[slc], data)
+        self._commit(measurement, {self._blurSigma: {name: getattr(score, name) for name in self._scorers}})
+
+    def scoreRemaining(self, measurements: t_.Sequence[ITOMeasurement]):
+        """Score the measurements that weren't passed to `scoreTransformed`, loading their data from file."""
+        for m in measurements:
+            if self._key(m) not in self._commits:
+                _, cached = _loadCachedScores(m.loadTransformedData(self._loader.template.idTag), self._scorers, self._blurSigma, self._dtype, self._useCache)
+                template = self._getTemplate() if len(cached) < len(self._scorers) else None
+                self._commit(m, _calculateBlurSweep(m, (self._blurSigma,), self._loader.template.idTag, self._scorers,
+                                                    self._dtype, self._useCache, {self._blurSigma: template}))
+
+    def getOutput(self, measurements: t_.Sequence[ITOMeasurement]) -> pd.DataFrame:
+        """Wait for the scores of `measurements` to be committed and return them in the same format as `TransformedDataScorer`.
+        The commits of `measurements` are forgotten afterwards, scoring them again will start new commits."""
+        commits = [self._commits.pop(self._key(m)) for m in measurements]
+        return pd.DataFrame([commit.result()[0].drop('blurSigma') for commit in commits])
 
 
 class TransformedDataSaver:
@@ -132,54 +580,147 @@ class TransformedDataSaver:
             the transform generation.
         method: Selects which method the transform generator should use. All possible options are stored in the
             `TransformGenerator.Method` enum.
+        dtype: The floating point precision that the transformed data is calculated and saved in.
+        streaming: If `True` then the transformed data is warped one block of wavelengths at a time and written straight
+            to file. Peak memory is then roughly one untransformed cube plus one block rather than two full cubes.
+        registry: If provided then the aligned data of each newly transformed measurement, cropped to its valid region
+            and in `dtype`, is also placed in this registry under the name of the measurement. `TransformedDataScorer`
+            can then score it without loading it back from file. The arrays stay in shared memory until they are
+            released, so this should only be used when the data of all the measurements fits in memory.
+        writer: If provided then the files are written on this writer's background thread so that writing overlaps with
+            transforming the next measurement.
+        onTransformed: If provided then this is called with each measurement, the valid data slice and the aligned
+            data inside it (in `dtype`) as soon as the measurement has been transformed. The data must not be modified.
+            `streaming` is ignored when this is provided since the whole cube is needed in memory anyway.
+        matcher: A `TransformGenerator` for the template of `loader` to reuse instead of creating a new one. `debugMode`
+            and `method` are ignored when this is provided.
 
     """
-    def __init__(self, loader: AbstractMeasurementLoader, useCached: bool = True, debugMode: bool = False, method: TransformGenerator.Method = TransformGenerator.Method.XCORR):
+    translationTolerance = 1e-3  # Transforms that move every pixel by a whole number of pixels, to within this many pixels, are stored as a translation rather than warping the data.
+    blockBytes = 64 * 2**20  # The approximate size of each block of wavelengths that is warped at once.
+
+    def __init__(self, loader: AbstractMeasurementLoader, useCached: bool = True, debugMode: bool = False, method: TransformGenerator.Method = TransformGenerator.Method.XCORR,
+                 dtype: np.dtype = np.float32, streaming: bool = True, registry: t_.Optional[SharedArrayRegistry] = None,
+                 writer: t_.Optional[_BackgroundWriter] = None,
+                 onTransformed: t_.Optional[t_.Callable[[ITOMeasurement, t_.Tuple[slice, slice], np.ndarray], None]] = None,
+                 matcher: t_.Optional[TransformGenerator] = None):
         self._loader = loader
+        self._dtype = dtype
+        self._streaming = streaming and onTransformed is None
+        self._registry = registry
+        self._writer = writer
+        self._onTransformed = onTransformed
         logger = logging.getLogger(__name__)
 
-        resultPairs = []
-        if useCached:
-            needsProcessing = []
-            for m in self._loader.measurements:
-                if self._loader.template.idTag in m.listTransformedData():
-                    logger.debug(f"Loading cached results for {m.name}")
-                    result = m.loadTransformedData(self._loader.template.idTag)
-                    resultPairs.append((m, result))
-                else:  # No cached result was found. Add the measurement to the `needProcessing` list
-                    needsProcessing.append(m)
-        else:
-            needsProcessing = self._loader.measurements
-
-        self._matcher = TransformGenerator(loader.template.analysisResults, debugMode=debugMode, method=method)
-        transforms = self._matcher.match([i.analysisResults for i in needsProcessing])
-
-        transformedData = []
-        for transform, measurement in zip(transforms, needsProcessing):
-            if transform is None:
-                logger.debug(f"Skipping transformation of {measurement.name}")
+        with instrumentation.run('TransformedDataSaver'):
+            resultPairs = []
+            if useCached:
+                needsProcessing = []
+                for m in self._loader.measurements:
+                    if self._loader.template.idTag in m.listTransformedData():
+                        logger.debug(f"Loading cached results for {m.name}")
+                        result = m.loadTransformedData(self._loader.template.idTag)
+                        resultPairs.append((m, result))
+                        instrumentation.count('transformCache.hit', measurementName=m.name)
+                    else:  # No cached result was found. Add the measurement to the `needProcessing` list
+                        needsProcessing.append(m)
+                        instrumentation.count('transformCache.miss', measurementName=m.name)
             else:
-                transformedData.append(self._transformData(measurement, transform))
+                needsProcessing = self._loader.measurements
 
-        for measurement, tData in zip(needsProcessing, transformedData):
-            measurement.saveTransformedData(tData, overwrite=True)
+            self._matcher = TransformGenerator(loader.template.analysisResults, debugMode=debugMode, method=method) if matcher is None else matcher
+            transforms = self._matcher.match([i.analysisResults for i in needsProcessing])
 
-    def _transformData(self, measurement: ITOMeasurement, transform: np.ndarray) -> TransformedData:
+            for transform, measurement in zip(transforms, needsProcessing):
+                if transform is None:
+                    logger.debug(f"Skipping transformation of {measurement.name}")
+                else:  # Each measurement is saved before moving on to the next so that only one is ever held in memory.
+                    with instrumentation.measurement(measurement.name):
+                        self._transformAndSave(measurement, transform)
+
+    def _transformAndSave(self, measurement: ITOMeasurement, transform: np.ndarray):
         """
+        Align the data of a measurement to the template and save it to file.
 
         Args:
             measurement: A single `Measurement` of the calibration standard
             transform: The 2x3 affine transformation mapping the raw data to the template data.
-
-        Returns:
-            A transformeddata object
         """
         # transform = self._coerceAffineTransform(transform)
-        reflectance = self._applyTransform(transform, measurement)
-        return TransformedData.create(templateIdTag=self._loader.template.idTag,
-                                      affineTransform=transform,
-                                      transformedData=reflectance,
-                                      methodName=self._matcher.getMethodName())
+        logger = logging.getLogger(__name__)
+        results = measurement.analysisResults
+        shape = results.meanReflectance.shape
+        translation = self._integerTranslation(transform, shape)
+        if translation is not None:  # No need to warp, the aligned data is just an offset region of the original data.
+            logger.debug(f"Storing translation {tuple(translation)} for {measurement.name}")
+            tData = TransformedData.create(templateIdTag=self._loader.template.idTag,
+                                           affineTransform=transform,
+                                           transformedData=None,
+                                           methodName=self._matcher.getMethodName(),
+                                           translation=translation,
+                                           dataShape=np.array(shape))
+            self._save(measurement, tData)
+            if self._registry is not None or self._onTransformed is not None:
+                slc, data = tData.loadValidData(lambda srcSlc: np.add(results.reflectance.data[srcSlc], results.meanReflectance[srcSlc][:, :, None], dtype=self._dtype))
+                self._handOver(measurement, slc, data)
+            return
+        logger.debug(f"Starting data transformation of {measurement.name}")
+        if self._streaming:
+            fullShape = shape + (results.reflectance.data.shape[2],)
+            blocks = self._iterTransformedBlocks(transform, results, self._dtype)
+            if self._registry is not None:
+                blocks = self._shareBlocks(measurement.name, transform, fullShape, blocks)
+            dataStream = TransformedData.DataStream(shape=fullShape, dtype=np.dtype(self._dtype), blocks=blocks)
+            reflectance = None
+        else:
+            dataStream = None
+            reflectance = self._applyTransform(transform, results, self._dtype)
+        tData = TransformedData.create(templateIdTag=self._loader.template.idTag,
+                                       affineTransform=transform,
+                                       transformedData=reflectance,
+                                       methodName=self._matcher.getMethodName())
+        self._save(measurement, tData, dataStream)
+        if reflectance is not None:
+            slc = TransformedData.warpedValidSlice(transform, shape)
+            self._handOver(measurement, slc, reflectance[slc])
+
+    def _save(self, measurement: ITOMeasurement, tData: TransformedData, dataStream: t_.Optional[TransformedData.DataStream] = None):
+        if self._writer is None:
+            measurement.saveTransformedData(tData, overwrite=True, dataStream=dataStream)
+        else:
+            self._writer.submit(measurement.saveTransformedData, tData, overwrite=True, dataStream=dataStream)
+
+    def _handOver(self, measurement: ITOMeasurement, slc: t_.Tuple[slice, slice], data: np.ndarray):
+        """Pass aligned data that is in memory on to the `registry` and `onTransformed` if they were provided."""
+        if self._registry is not None:
+            self._registry.create(measurement.name, data, info=slc)
+        if self._onTransformed is not None:
+            self._onTransformed(measurement, slc, data)
+
+    def _shareBlocks(self, key: str, transform: np.ndarray, shape: t_.Tuple[int, int, int],
+                     blocks: t_.Iterable[t_.Tuple[slice, np.ndarray]]) -> t_.Iterator[t_.Tuple[slice, np.ndarray]]:
+        """Pass through the blocks of transformed data while copying their valid region into a new shared array in the registry."""
+        slc = TransformedData.warpedValidSlice(transform, shape[:2])
+        validShape = tuple(len(range(n)[s]) for s, n in zip(slc, shape[:2])) + (shape[2],)
+        shared = self._registry.allocate(key, validShape, self._dtype, info=slc)
+        try:
+            for wvSlc, block in blocks:
+                shared[:, :, wvSlc] = block[slc]
+                yield wvSlc, block
+        except BaseException:  # Don't leave partially filled data in the registry.
+            del shared
+            self._registry.release(key)
+            raise
+
+    @classmethod
+    def _integerTranslation(cls, transform: np.ndarray, shape: t_.Tuple[int, int]) -> t_.Optional[np.ndarray]:
+        """If `transform` only translates an image of `shape` by a whole number of pixels then return the
+        (rows, columns) offset of the translation. Otherwise return `None`."""
+        linearError = np.abs(transform[:, :2] - np.eye(2)).sum(axis=1).max() * max(shape)  # The largest displacement caused by scaling, rotation or shear.
+        translation = transform[:, 2]
+        if linearError + np.abs(translation - np.round(translation)).max() > cls.translationTolerance:
+            return None
+        return np.round(translation[::-1]).astype(int)  # Convert from (x, y) to (rows, columns)
 
     @staticmethod
     def _coerceAffineTransform(transform: np.ndarray):
@@ -192,22 +733,51 @@ class TransformedDataSaver:
         transform = transform.toPartialMatrix()
         return transform
 
-    @staticmethod
-    def _applyTransform(transform: np.ndarray, measurement: ITOMeasurement):
-        logger = logging.getLogger(__name__)
-        logger.debug(f"Starting data transformation of {measurement.name}")
-        im = measurement.analysisResults.meanReflectance
+    @classmethod
+    def _applyTransform(cls, transform: np.ndarray, results: PWSAnalysisResults, dtype: np.dtype = np.float32) -> np.ndarray:
+        """Warp the reflectance of `results` into the template's coordinates. The full output array is held in memory."""
+        blocks = cls._iterTransformedBlocks(transform, results, dtype)
+        slc, block = next(blocks)
+        reflectance = np.empty(block.shape[:2] + (results.reflectance.data.shape[2],), dtype=dtype)
+        reflectance[:, :, slc] = block
+        for slc, block in blocks:
+            reflectance[:, :, slc] = block
+        return reflectance
+
+    @classmethod
+    def _iterTransformedBlocks(cls, transform: np.ndarray, results: PWSAnalysisResults, dtype: np.dtype = np.float32) -> t_.Iterator[t_.Tuple[slice, np.ndarray]]:
+        """
+        Warp the reflectance of `results` into the template's coordinates one block of wavelengths at a time.
+
+        Args:
+            transform: The 2x3 affine transformation mapping the raw data to the template data.
+            results: The analysis results of the measurement. The reflectance cube is released once all blocks are done.
+            dtype: The floating point precision of the output.
+
+        Yields:
+            A slice along the wavelength axis and the transformed block of data for those wavelengths. Invalid regions are `numpy.nan`.
+        """
+        im = results.meanReflectance.astype(dtype, copy=False)
         tform = cv2.invertAffineTransform(transform)
-        meanReflectance = cv2.warpAffine(im, tform, im.shape, borderValue=-666.0, flags=cv2.INTER_NEAREST)  # Blank regions after transform will have value -666, can be used to generate a mask.
+        dsize = (im.shape[1], im.shape[0])  # OpenCV sizes are (width, height)
+        meanReflectance = cv2.warpAffine(im, tform, dsize, borderValue=-666.0, flags=cv2.INTER_NEAREST)  # Blank regions after transform will have value -666, can be used to generate a mask.
         mask = meanReflectance == -666.0
         mask = binary_dilation(mask)  # Due to interpolation we sometimes get weird values at the edge. dilate the mask so that those edges get cut off.
-        kcube = measurement.analysisResults.reflectance
-        reflectance = np.zeros_like(kcube.data)
-        for i in range(kcube.data.shape[2]):
-            reflectance[:, :, i] = cv2.warpAffine(kcube.data[:, :, i], tform, kcube.data.shape[:2]) + meanReflectance
-        measurement.analysisResults.releaseMemory()
-        reflectance[mask] = np.nan
-        return reflectance
+        with instrumentation.span('load'):
+            kcube = results.reflectance
+        instrumentation.count('bytesRead', kcube.data.nbytes)
+        remap = AffineRemap(tform, dsize)
+        numWavelengths = kcube.data.shape[2]
+        blockSize = max(1, cls.blockBytes // (im.size * np.dtype(dtype).itemsize))
+        for start in range(0, numWavelengths, blockSize):
+            slc = slice(start, min(start + blockSize, numWavelengths))
+            with instrumentation.span('warp'):
+                block = remap.apply(kcube.data[:, :, slc], dtype=dtype)
+                block += meanReflectance[:, :, None]
+                block[mask] = np.nan
+            yield slc, block
+        del kcube
+        results.releaseMemory()
 
 
 class Analyzer:
@@ -226,9 +796,263 @@ class Analyzer:
             `TransformGenerator.Method` enum.
         blurSigma: This value sets the `sigma` of the gaussian blur that occurs at the beginning of the scoring process.
             Units are in pixels. See documentation for `TransformedDataScorer` for more information.
+        dtype: The floating point precision used for transforming, blurring and scoring the data.
+        scorers: The names of the `CombinedScore` sub-scores to calculate. If `None` then all of them are calculated.
+        parallel: If `True` then the measurements are scored in parallel. See `TransformedDataScorer`.
+        pipelined: If `True` then each measurement is scored from memory as soon as it has been transformed while its
+            file is compressed and written on a background thread. Transforming and scoring run one after the other on
+            the calling thread, only the writing of each file overlaps with the transforming and scoring of the next
+            measurements. The data never has to be read back from file. `parallel` is ignored.
+        sharedMemory: If `True` then the aligned data of every newly transformed measurement is kept in shared memory
+            until it has been scored rather than being loaded back from file. The data of all of the measurements is
+            held at once, which for large sets can exceed the size of `/dev/shm` and crash the process, so this should
+            only be used when it all fits in memory. Ignored if `pipelined` is `True`.
+        scoreName: The name that the scores are saved under in each measurement's file. If `None` then
+            `CombinedScore.defaultScoreName` is used, so scores of a subset of `scorers` never overwrite full scores.
     """
     def __init__(self, loader: AbstractMeasurementLoader, useCached: bool = True, debugMode: bool = False,
-                 method: TransformGenerator.Method = TransformGenerator.Method.XCORR, blurSigma: float = None):
-        self.transformer = TransformedDataSaver(loader, useCached, debugMode, method)
-        self.scorer = TransformedDataScorer(loader, 'score', blurSigma)
-        self.output = self.scorer.output
\ No newline at end of file
+                 method: TransformGenerator.Method = TransformGenerator.Method.XCORR, blurSigma: float = None,
+                 dtype: np.dtype = np.float32, scorers: t_.Optional[t_.Sequence[str]] = None, parallel: bool = False,
+                 pipelined: bool = False, sharedMemory: bool = False, scoreName: t_.Optional[str] = None):
+        scoreName = CombinedScore.defaultScoreName(scorers) if scoreName is None else scoreName
+        with instrumentation.run('Analyzer'):
+            if pipelined:
+                with _BackgroundWriter() as writer:
+                    self.scorer = _PipelinedScorer(loader, scoreName, blurSigma, dtype, scorers, True, writer)
+                    self.transformer = TransformedDataSaver(loader, useCached, debugMode, method, dtype=dtype, writer=writer,
+                                                            onTransformed=self.scorer.scoreTransformed)
+                    self.scorer.scoreRemaining(loader.measurements)
+                self.output = self.scorer.getOutput(loader.measurements)
+                return
+            # If enabled, the aligned data is handed straight from the transformer to the scorer in shared memory.
+            with SharedArrayRegistry() if sharedMemory else contextlib.nullcontext() as registry:
+                self.transformer = TransformedDataSaver(loader, useCached, debugMode, method, dtype=dtype, registry=registry)
+                self.scorer = TransformedDataScorer(loader, scoreName, blurSigma, parallel=parallel, dtype=dtype, scorers=scorers, registry=registry)
+            self.output = self.scorer.output
+
+
+class AsyncAnalyzer:
+    """
+    Runs the same analysis as `Analyzer` with `pipelined=True` on a background thread and returns right away, so that
+    it can be used from a GUI without freezing it. Progress is reported through futures and an optional callback.
+
+    Args:
+        loader: A data loader object that provides access to a `template` measurement and a sequence of `measurement`
+            measurements.
+        useCached: See `Analyzer`.
+        method: See `Analyzer`.
+        blurSigma: See `Analyzer`.
+        dtype: See `Analyzer`.
+        scorers: See `Analyzer`.
+        onProgress: If provided then this is called with the stage, the number of measurements that have finished the
+            stage and the total number of measurements in the stage each time a measurement finishes a stage. It is
+            called from a background thread.
+        scoreName: See `Analyzer`.
+
+    Attributes:
+        future: Resolves to the same `DataFrame` as `Analyzer.output` once everything has finished.
+        stageFutures: A future for each `Stage` that resolves to `None` once every measurement has finished the stage.
+        measurementFutures: A future for each measurement, keyed by measurement name, that resolves to its row of the
+            output (a `pd.Series`) as soon as it has been scored and written to file.
+    """
+    class Stage(enum.Enum):
+        TRANSFORM = "Transforming"
+        SCORE = "Scoring"
+
+    def __init__(self, loader: AbstractMeasurementLoader, useCached: bool = True,
+                 method: TransformGenerator.Method = TransformGenerator.Method.XCORR, blurSigma: float = None,
+                 dtype: np.dtype = np.float32, scorers: t_.Optional[t_.Sequence[str]] = None,
+                 onProgress: t_.Optional[t_.Callable[[AsyncAnalyzer.Stage, int, int], None]] = None,
+                 scoreName: t_.Optional[str] = None):
+        self._loader = loader
+        self._onProgress = onProgress
+        self._lock = threading.Lock()
+        self._finished = {stage: 0 for stage in self.Stage}
+        self._totals = {stage: len(loader.measurements) for stage in self.Stage}
+        self.stageFutures: t_.Dict[AsyncAnalyzer.Stage, cf.Future] = {stage: cf.Future() for stage in self.Stage}
+        self.measurementFutures: t_.Dict[str, cf.Future] = {m.name: cf.Future() for m in loader.measurements}
+        for f in list(self.stageFutures.values()) + list(self.measurementFutures.values()):
+            f.set_running_or_notify_cancel()
+        executor = cf.ThreadPoolExecutor(max_workers=1, thread_name_prefix="AsyncAnalyzer")
+        scoreName = CombinedScore.defaultScoreName(scorers) if scoreName is None else scoreName
+        self.future = executor.submit(self._run, useCached, method, blurSigma, dtype, scorers, scoreName)
+        self.future.add_done_callback(self._failRemaining)
+        executor.shutdown(wait=False)
+
+    def _reportProgress(self, stage: AsyncAnalyzer.Stage, n: int = 1):
+        with self._lock:
+            self._finished[stage] += n
+            finished = self._finished[stage]
+        if self._onProgress is not None:
+            self._onProgress(stage, finished, self._totals[stage])
+
+    def _run(self, useCached: bool, method: TransformGenerator.Method, blurSigma: t_.Optional[float], dtype: np.dtype,
+             scorers: t_.Optional[t_.Sequence[str]], scoreName: str) -> pd.DataFrame:
+        def onTransformed(measurement: ITOMeasurement, slc: t_.Tuple[slice, slice], data: np.ndarray):
+            scorer.scoreTransformed(measurement, slc, data)
+            self._reportProgress(self.Stage.TRANSFORM)
+
+        with instrumentation.run('AsyncAnalyzer'):
+            needsTransform = [m for m in self._loader.measurements if not (useCached and self._loader.template.idTag in m.listTransformedData())]
+            self._totals[self.Stage.TRANSFORM] = len(needsTransform)
+            with _BackgroundWriter() as writer:
+                scorer = _PipelinedScorer(self._loader, scoreName, blurSigma, dtype, scorers, True, writer, onCommit=self._onCommit)
+                TransformedDataSaver(self._loader, useCached, method=method, dtype=dtype, writer=writer, onTransformed=onTransformed)
+                self.stageFutures[self.Stage.TRANSFORM].set_result(None)
+                scorer.scoreRemaining(self._loader.measurements)
+            self.stageFutures[self.Stage.SCORE].set_result(None)
+            return scorer.getOutput(self._loader.measurements)
+
+    def _onCommit(self, measurement: ITOMeasurement, commit: cf.Future):
+        def done(commit: cf.Future):
+            if commit.exception() is not None:
+                self.measurementFutures[measurement.name].set_exception(commit.exception())
+                return
+            self.measurementFutures[measurement.name].set_result(commit.result()[0].drop('blurSigma'))
+            self._reportProgress(self.Stage.SCORE)
+        commit.add_done_callback(done)
+
+    def _failRemaining(self, future: cf.Future):
+        """If the analysis failed then pass the error on to the futures that will never finish."""
+        if future.exception() is None:
+            return
+        for f in list(self.stageFutures.values()) + list(self.measurementFutures.values()):
+            try:
+                f.set_exception(future.exception())
+            except cf.InvalidStateError:  # It already finished.
+                pass
+
+    def result(self, timeout: float = None) -> pd.DataFrame:
+        """Block until the analysis has finished and return the output. See `Analyzer.output`."""
+        return self.future.result(timeout)
+
+
+class _BatchLoader(AbstractMeasurementLoader):
+    def __init__(self, template: ITOMeasurement, measurements: t_.Sequence[ITOMeasurement]):
+        self._template = template
+        self._measurements = tuple(measurements)
+
+    @property
+    def template(self) -> ITOMeasurement:
+        return self._template
+
+    @property
+    def measurements(self) -> t_.Sequence[ITOMeasurement]:
+        return self._measurements
+
+
+class IncrementalAnalyzer:
+    """
+    A long-running version of `Analyzer` that watches a directory for new measurement folders and analyzes only those,
+    appending the scores to `output`. The template's transform generator and prepared scoring template are kept in
+    memory between measurements so each new folder only costs the transform and scoring of its own data. Uses the
+    optional `watchdog` package to be notified of new folders, otherwise the directory is polled.
+
+    Args:
+        directory: The directory that new measurement folders are added to. Each folder is loaded with
+            `loaderType.loadMeasurement`.
+        templateDirectory: The folder of the template measurement.
+        blurSigma: See `Analyzer`.
+        dtype: See `Analyzer`.
+        scorers: See `Analyzer`.
+        method: See `Analyzer`.
+        processExisting: If `True` then the folders that are already in `directory` are analyzed first. Their cached
+            results are used when available. Otherwise only folders that are added later are analyzed.
+        settleTime: A new folder is only analyzed once nothing inside of it has been modified for this many seconds.
+        onResult: If provided then this is called with the `DataFrame` of the scores of each batch of new measurements.
+        loaderType: The loader class that is used to load the measurement of each folder.
+        scoreName: See `Analyzer`.
+    """
+    def __init__(self, directory: str, templateDirectory: str, blurSigma: float = None, dtype: np.dtype = np.float32,
+                 scorers: t_.Optional[t_.Sequence[str]] = None, method: TransformGenerator.Method = TransformGenerator.Method.XCORR,
+                 processExisting: bool = False, settleTime: float = 60.0,
+                 onResult: t_.Optional[t_.Callable[[pd.DataFrame], None]] = None, loaderType: t_.Type = None,
+                 scoreName: t_.Optional[str] = None):
+        self._loaderType = DateMeasurementLoader if loaderType is None else loaderType
+        self._template = self._loaderType.loadMeasurement(templateDirectory)
+        self._dtype = dtype
+        self._onResult = onResult
+        self._watcher = FolderWatcher(directory, settleTime=settleTime, ignoreExisting=not processExisting)
+        self._matcher = TransformGenerator(self._template.analysisResults, method=method)
+        self._writer = _BackgroundWriter()
+        self._scorer = _PipelinedScorer(_BatchLoader(self._template, ()), CombinedScore.defaultScoreName(scorers) if scoreName is None else scoreName, blurSigma, dtype, scorers, True, self._writer)
+        self._thread: t_.Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._output = pd.DataFrame()
+
+    @property
+    def output(self) -> pd.DataFrame:
+        """The scores of all of the measurements that have been analyzed so far."""
+        with self._lock:
+            return self._output
+
+    def analyzeFolders(self, directories: t_.Sequence[str]) -> pd.DataFrame:
+        """
+        Analyze the measurements in `directories` and append their scores to `output`. Folders that fail to load are
+        logged and skipped.
+
+        Returns:
+            The scores of the measurements that were analyzed.
+        """
+        logger = logging.getLogger(__name__)
+        measurements = []
+        for directory in directories:
+            if os.path.abspath(directory) == os.path.abspath(self._template.filePath):
+                continue
+            try:
+                measurements.append(self._loaderType.loadMeasurement(directory))
+            except Exception:
+                logger.exception(f"Failed to load measurement at directory {directory}. It will be retried if it changes.")
+                self._watcher.retryWhenModified(directory)
+        if len(measurements) == 0:
+            return pd.DataFrame()
+        logger.info(f"Analyzing {len(measurements)} new measurements: {', '.join(m.name for m in measurements)}")
+        loader = _BatchLoader(self._template, measurements)
+        with instrumentation.run('IncrementalAnalyzer'):
+            TransformedDataSaver(loader, dtype=self._dtype, writer=self._writer, onTransformed=self._scorer.scoreTransformed, matcher=self._matcher)
+            self._scorer.scoreRemaining(measurements)
+            result = self._scorer.getOutput(measurements)
+        with self._lock:
+            self._output = pd.concat([self._output, result], ignore_index=True)
+        if self._onResult is not None:
+            self._onResult(result)
+        return result
+
+    def run(self):
+        """Analyze new folders as they appear until `stop` is called. Blocks the calling thread."""
+        self._watcher.start()
+        try:
+            while not self._watcher.stopped:
+                folders = self._watcher.waitForNew()
+                if len(folders) > 0:
+                    try:
+                        self.analyzeFolders(folders)
+                    except Exception:  # Keep watching, the next batch may be fine.
+                        logging.getLogger(__name__).exception(f"Failed to analyze {', '.join(folders)}")
+        finally:
+            self._watcher.stop()
+
+    def start(self):
+        """Run `run` on a background thread."""
+        if self._thread is not None:
+            raise RuntimeError("The analyzer has already been started.")
+        self._thread = threading.Thread(target=self.run, name="IncrementalAnalyzer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching for new folders. The batch that is currently being analyzed is finished first."""
+        self._watcher.stop()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """Stop and wait for all of the results to be written to file."""
+        self.stop()
+        self._writer.close()
+
+    def __enter__(self) -> IncrementalAnalyzer:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,4 +1,6 @@
 from __future__ import annotations
+import dataclasses
+import hashlib
 import json
 import math
 import os
@@ -9,19 +11,38 @@ import h5py
 import numpy as np
 from pwspy import dateTimeFormat
 from pwspy.analysis import AbstractHDFAnalysisResults
+from pws_calibration_suite.comparison import instrumentation
 from pws_calibration_suite.comparison._scorers import Score, CombinedScore
 
 
 class TransformedData(AbstractHDFAnalysisResults):
     FileSuffix = "_transformedData.h5"
 
+    @dataclasses.dataclass
+    class DataStream:
+        """
+        Describes `transformedData` that is produced one block of wavelengths at a time so that it can be written to file
+        without ever holding the full array in memory.
+
+        Attributes:
+            shape: The (rows, columns, wavelengths) shape of the full array.
+            dtype: The data type of the full array.
+            blocks: An iterable of (wavelengthSlice, block) pairs that together cover the full array.
+        """
+        shape: typing.Tuple[int, int, int]
+        dtype: np.dtype
+        blocks: typing.Iterable[typing.Tuple[slice, np.ndarray]]
+
     @classmethod
-    def create(cls, templateIdTag: str, affineTransform: np.ndarray, transformedData: np.ndarray, methodName: str) -> TransformedData:  # Inherit docstring
+    def create(cls, templateIdTag: str, affineTransform: np.ndarray, transformedData: typing.Optional[np.ndarray], methodName: str,
+               translation: typing.Optional[np.ndarray] = None, dataShape: typing.Optional[np.ndarray] = None) -> TransformedData:  # Inherit docstring
         d = {'templateIdTag': templateIdTag,
              'affineTransform': affineTransform,
              'transformedData': transformedData,
              'methodName': methodName,
-             'creationTime': datetime.now().strftime(dateTimeFormat)}
+             'creationTime': datetime.now().strftime(dateTimeFormat),
+             'translation': translation,
+             'dataShape': dataShape}
         return cls(None, d)
 
     @staticmethod
@@ -31,7 +52,9 @@ class TransformedData(AbstractHDFAnalysisResults):
             'affineTransform',  # A 2x3 matrix specifying the affine transformation between the template data and this data.
             'transformedData',  # The data after having been warped by `afffineTransform` invalid regions of data will be marked as numpy.nan
             'methodName',  # A string indicating the type of method used to determine which computer-vision method was used to determine the affine transform
-            'creationTime'  # The timestamp indicating when this object was first created.
+            'creationTime',  # The timestamp indicating when this object was first created.
+            'translation',  # If the affine transform is a translation by a whole number of pixels then only the (rows, columns) offset is stored rather than `transformedData`. `None` if the data was warped.
+            'dataShape'  # The (rows, columns) shape of the data. Only stored along with `translation`.
         )
 
     @AbstractHDFAnalysisResults.FieldDecorator
@@ -55,16 +78,36 @@ class TransformedData(AbstractHDFAnalysisResults):
         """The time that the analysis was performed."""
         return bytes(self.file['creationTime'][()]).decode()
 
+    @AbstractHDFAnalysisResults.FieldDecorator
+    def translation(self) -> typing.Optional[np.ndarray]:
+        """The aligned data at [row, column] is the original data at [row + translation[0], column + translation[1]]."""
+        if 'translation' not in self.file:
+            return None  # The data was warped. Files from before translations were supported are also warped.
+        return np.array(self.file['translation'])
+
+    @AbstractHDFAnalysisResults.FieldDecorator
+    def dataShape(self) -> typing.Optional[np.ndarray]:
+        if 'dataShape' not in self.file:
+            return None
+        return np.array(self.file['dataShape'])
+
     @property
     def idTag(self) -> str:
         return f"{self.templateIdTag}_{self.creationTime}"
 
     def getValidDataSlice(self) -> typing.Tuple[slice, slice]:
         """Use the affine transformation from a calibration result to create a 2d slice that will select out only the valid parts of the data"""
-        shape = self.transformedData.shape
+        if self.translation is not None:
+            # Whole pixel translations aren't interpolated so every pixel that overlaps the original data is valid.
+            return tuple(slice(max(0, -int(t)), min(int(n), int(n) - int(t))) for t, n in zip(self.translation, self.dataShape))
+        return self.warpedValidSlice(self.affineTransform, self.transformedData.shape[:2])
+
+    @staticmethod
+    def warpedValidSlice(affineTransform: np.ndarray, shape: typing.Tuple[int, int]) -> typing.Tuple[slice, slice]:
+        """The 2d slice selecting the valid parts of data of (rows, columns) `shape` that was warped by `affineTransform`."""
         origRect = np.array([[0, 0], [shape[1], 0], [shape[1], shape[0]], [0, shape[0]]]).astype(np.float32)  # Coordinates are in X,Y format rather than row, column
         # Generate coordinates of corners of the original image after affine transformation.
-        tRect = cv2.transform(origRect[None, :, :], cv2.invertAffineTransform(self.affineTransform))[0, :, :]  # For some reason this needs to be 3d for opencv to work.
+        tRect = cv2.transform(origRect[None, :, :], cv2.invertAffineTransform(affineTransform))[0, :, :]  # For some reason this needs to be 3d for opencv to work.
         leftCoords = [tRect[0][0], tRect[3][0]]
         topCoords = [tRect[2][1], tRect[3][1]]
         rightCoords = [tRect[1][0], tRect[2][0]]
@@ -84,6 +127,27 @@ class TransformedData(AbstractHDFAnalysisResults):
         slc = (slice(bottom, top), slice(left, right))  # A rectangular slice garaunteed to lie entirely inside the valid data aread, even if the transform has rotation.
         return slc
 
+    def loadValidData(self, loadSource: typing.Callable[[typing.Tuple[slice, slice]], np.ndarray],
+                      measurementName: str = None) -> typing.Tuple[typing.Tuple[slice, slice], np.ndarray]:
+        """Get the part of the transformed data selected by `getValidDataSlice`.
+
+        Args:
+            loadSource: Only called if the data was stored as a `translation`. Takes a lateral slice of the original,
+                untransformed, data and returns that region of the data.
+            measurementName: The measurement that reading the data is recorded under, see `instrumentation.span`.
+
+        Returns:
+            A tuple of the valid data slice and the transformed data inside of it.
+        """
+        if self.translation is None:
+            with instrumentation.span('load', measurementName):
+                slc = self.getValidDataSlice()  # Reads the whole `transformedData` array to get its shape.
+                data = self.transformedData[slc]
+            instrumentation.count('bytesRead', self.transformedData.nbytes, measurementName)
+            return slc, data
+        slc = self.getValidDataSlice()
+        return slc, loadSource(tuple(slice(s.start + int(t), s.stop + int(t)) for s, t in zip(slc, self.translation)))
+
     @staticmethod
     def name2FileName(name: str) -> str:
         return f"{name}{TransformedData.FileSuffix}"
@@ -95,9 +159,25 @@ class TransformedData(AbstractHDFAnalysisResults):
             raise NameError(f"{fileName} is not recognized as a TransformedData file.")
         return os.path.basename(fileName)[:-len(TransformedData.FileSuffix)]
 
-    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: str = 'gzip'):
-        """Override super-implementation to default to gzip compression of data. Cuts file size by more than half."""
+    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: str = 'gzip', dataStream: typing.Optional[TransformedData.DataStream] = None):
+        """Override super-implementation to default to gzip compression of data. Cuts file size by more than half.
+        If `dataStream` is provided then the `transformedData` field is written from it one block at a time into a
+        dataset that is chunked by wavelength. In that case `transformedData` itself should be `None`."""
         super().toHDF(directory, name, overwrite=overwrite, compression=compression)
+        if dataStream is None:
+            return
+        assert self.transformedData is None, "`transformedData` must be `None` when a `dataStream` is provided."
+        fileName = os.path.join(directory, self.name2FileName(name))
+        try:
+            with open(fileName, 'r+b') as pythonFile:  # Use a python file object like the super implementation does, the default HDF5 driver has write errors on Samba shares.
+                with h5py.File(pythonFile, 'r+', driver='fileobj') as hf:
+                    ds = hf.create_dataset('transformedData', shape=dataStream.shape, dtype=dataStream.dtype,
+                                           chunks=tuple(dataStream.shape[:2]) + (1,), compression=compression)
+                    for slc, block in dataStream.blocks:
+                        ds[:, :, slc] = block
+        except BaseException:
+            os.remove(fileName)  # Don't leave a file without data behind, it would be mistaken for a valid cached result.
+            raise
 
     def addScore(self, name: str, scores: Score, overwrite: bool = False):
         if self.file is None:
@@ -115,6 +195,48 @@ class TransformedData(AbstractHDFAnalysisResults):
             raise KeyError(f"No score named {name}")
         return CombinedScore.fromJson(bytes(self.file['scores'][name][()]).decode())
 
+    def scoreCacheKey(self, scorerName: str, scorerVersion: int, blurSigma: typing.Optional[float], dtype: np.dtype,
+                      scorerConfig: typing.Optional[typing.Dict[str, typing.Any]] = None) -> str:
+        """Generate a key that identifies all of the inputs of a sub-score calculated from this data. The `idTag` of
+        this object already identifies both the template and the transformed data.
+
+        Args:
+            scorerName: The name of the sub-score. E.g. one of the fields of `CombinedScore`.
+            scorerVersion: The `version` of the scorer class.
+            blurSigma: The sigma of the gaussian blur applied before scoring.
+            dtype: The floating point precision that the score was calculated with.
+            scorerConfig: The settings of the scorer that change its results, see `Score.cacheConfig`.
+        """
+        inputs = {'transformedData': self.idTag, 'scorer': scorerName, 'version': scorerVersion,
+                  'blurSigma': None if blurSigma is None else float(blurSigma), 'dtype': np.dtype(dtype).name}
+        if scorerConfig:  # Left out when empty so that the keys of scorers without any settings don't change.
+            inputs['config'] = scorerConfig
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def getCachedScore(self, key: str, scoreType: typing.Type[Score]) -> typing.Optional[Score]:
+        """Load a sub-score that was saved with `addCachedScore`. Returns `None` if no score is cached under `key`."""
+        if self.file is None:
+            raise ValueError("Cannot load scores from TransformedData that is not yet saved to file")
+        if ('scoreCache' not in self.file) or (key not in self.file['scoreCache']):
+            return None
+        return scoreType.fromJson(bytes(self.file['scoreCache'][key][()]).decode())
+
+    def addCachedScore(self, key: str, score: Score):
+        """Save a sub-score under a key generated by `scoreCacheKey` so that it can be reused rather than recalculated."""
+        if self.file is None:
+            raise ValueError("Cannot save score to TransformedData that is not yet saved to file")
+        if 'scoreCache' not in self.file:
+            self.file.create_group('scoreCache')
+        if key in self.file['scoreCache']:
+            del self.file['scoreCache'][key]
+        self.file['scoreCache'].create_dataset(key, data=np.string_(score.toJson()))
+
+    def clearScoreCache(self):
+        if self.file is None:
+            raise ValueError("Cannot load scores from TransformedData that is not yet saved to file")
+        if 'scoreCache' in self.file:
+            del self.file['scoreCache']
+
     def clearScores(self):
         if self.file is None:
             raise ValueError("Cannot load scores from TransformedData that is not yet saved to file")
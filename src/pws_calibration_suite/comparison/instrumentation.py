@@ -0,0 +1,218 @@
+"""
+Opt-in timing and counters for finding the bottlenecks of the analysis. Named spans (e.g. `load`, `warp`, `blur`,
+`score.ssim`, `write`) time sections of code and counters (e.g. `bytesRead`, `scoreCache.hit`) accumulate values.
+Nothing is recorded unless a `Recorder` is active, the durations of spans are always logged at the debug level.
+
+Recording can be turned on without editing code by setting the `PWSCAL_INSTRUMENTATION` environment variable to a
+file path. The results are then exported to that file when the process exits, as CSV if the path ends with `.csv`
+and as JSON otherwise.
+
+Examples:
+    with Recorder() as recorder:
+        Analyzer(loader, blurSigma=2)
+    recorder.toCsv('timings.csv')
+"""
+from __future__ import annotations
+import atexit
+import collections
+import contextlib
+import csv
+import dataclasses
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import typing
+
+ENVIRONMENT_VARIABLE = 'PWSCAL_INSTRUMENTATION'
+
+
+@dataclasses.dataclass
+class Record:
+    """
+    A single measured value.
+
+    Attributes:
+        kind: Either "span" or "counter".
+        name: The name of the span or counter.
+        value: The duration in seconds for spans, the amount that was added for counters.
+        measurement: The name of the measurement that the value belongs to, if any.
+        run: The number of the run (e.g. one `Analyzer`) that the value belongs to, if any.
+        thread: The name of the thread that recorded the value.
+    """
+    kind: str
+    name: str
+    value: float
+    measurement: typing.Optional[str] = None
+    run: typing.Optional[int] = None
+    thread: typing.Optional[str] = None
+
+
+class Recorder:
+    """
+    Collects the spans and counters recorded while it is active. Recording is thread safe. Can be used as a context
+    manager that activates the recorder on entry and restores the previously active recorder on exit.
+    """
+    summaryFields = ('run', 'measurement', 'kind', 'name', 'count', 'total', 'mean', 'max')
+
+    def __init__(self):
+        self._records: typing.List[Record] = []
+        self._lock = threading.Lock()
+        self._runNumbers = itertools.count()
+        self._previous: typing.List[typing.Optional[Recorder]] = []
+
+    def add(self, record: Record):
+        with self._lock:
+            self._records.append(record)
+
+    def extend(self, records: typing.Iterable[Record]):
+        with self._lock:
+            self._records.extend(records)
+
+    def nextRun(self) -> int:
+        return next(self._runNumbers)
+
+    @property
+    def records(self) -> typing.List[Record]:
+        with self._lock:
+            return list(self._records)
+
+    def summarize(self, byMeasurement: bool = True) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Aggregate the records of each span and counter.
+
+        Args:
+            byMeasurement: If `True` then the records are aggregated per run and measurement, otherwise only per run.
+
+        Returns:
+            A dictionary for each group with the fields in `summaryFields`.
+        """
+        groups = collections.OrderedDict()
+        for r in self.records:
+            key = (r.run, r.measurement if byMeasurement else None, r.kind, r.name)
+            groups.setdefault(key, []).append(r.value)
+        out = []
+        for (run, measurement, kind, name), values in groups.items():
+            out.append(dict(run=run, measurement=measurement, kind=kind, name=name, count=len(values),
+                            total=sum(values), mean=sum(values) / len(values), max=max(values)))
+        return out
+
+    def toDict(self) -> typing.Dict[str, typing.Any]:
+        return {'runs': self.summarize(byMeasurement=False),
+                'measurements': self.summarize(byMeasurement=True),
+                'records': [dataclasses.asdict(r) for r in self.records]}
+
+    def toJson(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.toDict(), f, indent=2)
+
+    def toCsv(self, path: str):
+        """Save the per run summary followed by the per measurement summary."""
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, self.summaryFields)
+            writer.writeheader()
+            writer.writerows(self.summarize(byMeasurement=False))
+            writer.writerows(r for r in self.summarize(byMeasurement=True) if r['measurement'] is not None)
+
+    def export(self, path: str):
+        """Save to CSV if `path` ends with `.csv`, otherwise to JSON."""
+        if path.lower().endswith('.csv'):
+            self.toCsv(path)
+        else:
+            self.toJson(path)
+
+    def __enter__(self) -> Recorder:
+        global _active
+        self._previous.append(_active)
+        _active = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _active
+        _active = self._previous.pop()
+
+
+_active: typing.Optional[Recorder] = None
+_currentRun: typing.Optional[int] = None  # Runs span several threads so this is shared by all threads.
+_context = threading.local()  # Holds the name of the measurement that the current thread is working on.
+
+
+def getRecorder() -> typing.Optional[Recorder]:
+    """The active recorder, `None` if nothing is being recorded."""
+    return _active
+
+
+def _record(kind: str, name: str, value: float, measurementName: typing.Optional[str]):
+    recorder = _active
+    if recorder is not None:
+        if measurementName is None:
+            measurementName = getattr(_context, 'measurement', None)
+        recorder.add(Record(kind, name, value, measurementName, _currentRun, threading.current_thread().name))
+
+
+@contextlib.contextmanager
+def span(name: str, measurementName: str = None):
+    """Time the code inside the `with` block. If `measurementName` isn't given then the measurement set by
+    `measurement` on the current thread is used."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        logging.getLogger(__name__).debug(f"{name} took {duration:.3f} seconds" + ("" if measurementName is None else f" for {measurementName}"))
+        _record('span', name, duration, measurementName)
+
+
+def count(name: str, value: float = 1, measurementName: str = None):
+    """Add `value` to a counter."""
+    _record('counter', name, value, measurementName)
+
+
+@contextlib.contextmanager
+def measurement(name: str):
+    """Attribute everything recorded on the current thread inside the `with` block to the measurement `name`."""
+    previous = getattr(_context, 'measurement', None)
+    _context.measurement = name
+    try:
+        yield
+    finally:
+        _context.measurement = previous
+
+
+@contextlib.contextmanager
+def run(name: str = 'run'):
+    """Group everything recorded inside the `with` block into a new run, which is also timed as a span named `name`.
+    Runs don't nest, inside of another run this only adds the span."""
+    global _currentRun
+    recorder = _active
+    if recorder is None or _currentRun is not None:
+        with span(name):
+            yield
+        return
+    _currentRun = recorder.nextRun()
+    try:
+        with span(name):
+            yield
+    finally:
+        _currentRun = None
+
+
+def merge(records: typing.Iterable[Record]):
+    """Add records that were collected in another process, e.g. by a worker process with its own `Recorder`, to the
+    active recorder and the current run."""
+    recorder = _active
+    if recorder is not None:
+        recorder.extend(dataclasses.replace(r, run=_currentRun) for r in records)
+
+
+def _enableFromEnvironment():
+    path = os.environ.get(ENVIRONMENT_VARIABLE)
+    if path and multiprocessing.parent_process() is None:  # Worker processes send their records back to the main process instead.
+        recorder = Recorder().__enter__()
+        atexit.register(recorder.export, path)
+
+
+_enableFromEnvironment()
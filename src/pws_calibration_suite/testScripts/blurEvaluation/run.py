@@ -5,7 +5,7 @@ Created on Thu Dec 10 17:08:42 2020
 @author: backman05
 """
 from pws_calibration_suite.comparison.TransformGenerator import TransformGenerator
-from pws_calibration_suite.comparison.analyzer import Analyzer, TransformedDataSaver, TransformedDataScorer
+from pws_calibration_suite.comparison.analyzer import Analyzer, TransformedDataSaver, BlurSweepScorer
 from pws_calibration_suite.testScripts.loader import Loader
 from importlib import reload
 import logging
@@ -39,10 +39,9 @@ if __name__ == '__main__':
         tData.clearScores()
 
     # Start scoring.
-    for blur in [2]:
-        logger.info(f"Starting blur {blur}")
-        stime = time.time()
-        scorer = TransformedDataScorer(loader, str(blur), blurSigma=blur,
-                                       parallel=True)
-        logger.info(f"Total score time: {time.time() - stime}")
+    blurs = [2]
+    logger.info(f"Starting blurs {blurs}")
+    stime = time.time()
+    scorer = BlurSweepScorer(loader, blurs, parallel=True)
+    logger.info(f"Total score time: {time.time() - stime}")
     a = 1  # BreakPoint
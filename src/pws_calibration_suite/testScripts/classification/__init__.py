@@ -37,13 +37,14 @@ def generateFeatures(rawDf: pd.DataFrame):
     funcDict = {
         'latXCorr': lambda row: row.score.latxcorr.score,
         'latXCorr_cdr': lambda row: np.sqrt((row.score.latxcorr.cdrY**2 + row.score.latxcorr.cdrX**2)/2),  # RMS of cdrx and cdry. Looking at data by eye this didn't look that useful, I'm inclined to get rid of it.
-        'latXCorr_cdr_eccent': lambda row: row.score.latxcorr.cdrY/row.score.latxcorr.cdrX,  # TODO this is not how eccentricity is measured and we will need to measure the major and minor axes of the the CDR not just X and Y
+        'latXCorr_cdr_eccent': lambda row: row.score.latxcorr.cdrY/row.score.latxcorr.cdrX,  # TODO this is not how eccentricity is measured. Kept as is since the saved scaler was fit on it, see `latXCorr_cdr_ellipseEccent`.
         'axXCorr': lambda row: row.score.axxcorr.score,
         'axXCorr_cdr': lambda row: row.score.axxcorr.cdr,
         'axXCorr_shift': lambda row: row.score.axxcorr.shift,
         'nrmse': lambda row: row.score.nrmse.score,
         'ssim': lambda row:  row.score.ssim.score,
-        'reflectance': lambda row: row.score.reflectance.reflectanceRatio
+        'reflectance': lambda row: row.score.reflectance.reflectanceRatio,
+        'latXCorr_cdr_ellipseEccent': lambda row: np.nan if row.score.latxcorr.cdrMajor is None else row.score.latxcorr.cdrEccentricity,  # Eccentricity of the ellipse fitted to the correlation peak. Not available for scores saved before the fit was added.
     }
     df = pd.DataFrame()
     for k, v in funcDict.items():